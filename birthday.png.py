@@ -8,12 +8,14 @@ import os
 import datetime
 import random
 from PIL import Image
-from PIL import ImageFont
 from PIL import ImageDraw 
 from collections import OrderedDict
-import io
+import sys
 import xlrd
 
+# Import rendercache (shared output cache), singleflight (coalesced requests), fontcache (loaded fonts), encoder (palette png, WebP) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import rendercache, singleflight, fontcache, encoder, conditional
+
 
 div_Y0=75                            # top and bottom margin
 div_X0=50                            # left and right margin
@@ -40,6 +42,16 @@ div_fgcolor_dbg=(220,220,220,255)    # foreground color for plain cells
 div_monthnames = ['Zero','January','February','March','April','May','June','July','August','September','October','November','December']
 div_bgcolors = [ (168,100,253,255), (41,205,255,255), (120,255,68,255), (255,113,141,255), (253,255,106,255) ]
 
+div_cache_ttl=3600                   # seconds a generated image is served from cache (and then again while refreshing)
+div_png_palette=True                 # encode the image with a palette (one byte per pixel) when its colors allow it
+div_png_level=9                      # zlib compression level of the png (1 is fastest, 9 is smallest); rendered once an hour
+div_png_optimize=True                # extra (slow) effort to find the smallest png
+div_webp_lossless=True               # WebP (for players that accept it) is lossless, or lossy at div_webp_quality
+div_webp_quality=80                  # WebP quality (lossy) or effort (lossless), 0-100
+
+# Generated images, keyed by normalized query string
+cache= rendercache.Cache(div_cache_ttl)
+
 # Converts a name,date list to a dictionary. 
 # The dictionary maps a month/date to a list of person that has birthday that date.
 # The returned object has a (month,day) as key and a list of name,date tuples as value
@@ -91,9 +103,9 @@ def table2Img(md_namedates_dict, dbg):
     # Start drawing on image
     newImage = Image.new('RGBA', (width,height), 0 )
     draw = ImageDraw.Draw(newImage)
-    font_cell = ImageFont.truetype(getPath(div_fontname_cell), div_fontsize_cell)
-    font_head = ImageFont.truetype(getPath(div_fontname_head), div_fontsize_head)
-    font_dbg = ImageFont.truetype(getPath(div_fontname_dbg), div_fontsize_dbg)
+    font_cell = fontcache.truetype(getPath(div_fontname_cell), div_fontsize_cell)
+    font_head = fontcache.truetype(getPath(div_fontname_head), div_fontsize_head)
+    font_dbg = fontcache.truetype(getPath(div_fontname_dbg), div_fontsize_dbg)
     # Draw confetti
     for ix in range(1, 150+random.randint(0,150)):
         X= random.randint(0, width)
@@ -164,28 +176,39 @@ def readXLSX(xlsname):
         log= "Failed to open '"+xlsname+"'" if len(xlsname)>0 else "Missing calender, append ?ehv-birthdays.xlsx to URL" 
     return (name_date_list,log)
 
+# Reads xls file `xlsname` and converts it to png bytes, and their ETag
+# The ETag is made from the birthdays and today's date, so it leaves out the confetti and the time stamp (they change on every render)
+def xls2png(xlsname):
+    name_date_list,log= readXLSX(xlsname)
+    md_namedates_dict= convert(name_date_list)
+    image= table2Img(md_namedates_dict,log)
+    bytes= encoder.png(image, palette=div_png_palette, compress_level=div_png_level, optimize=div_png_optimize)
+    etag= conditional.etag( (xlsname,sorted(md_namedates_dict.items()),log,datetime.date.today()) )
+    return bytes,etag
+
 def application(environ, start_response):
     xlsname= environ.get('QUERY_STRING')
     pos= xlsname.find("&")
     if pos>=0: xlsname= xlsname[:pos]
-    name_date_list,log= readXLSX(xlsname)
-    md_namedates_dict= convert(name_date_list)
-    image= table2Img(md_namedates_dict,log)
-    with io.BytesIO() as memfile:
-        image.save(memfile, format="png")
-        bytes= memfile.getvalue()
+    # The image depends on today's date (highlighted birthdays), so the date is part of the key
+    bytes,etag= cache.get( rendercache.normalize({'xls':xlsname,'date':datetime.date.today()}), lambda: xls2png(xlsname) )
     status= '200 OK'
-    response_header= [('Content-type','image/png')]
+    response_header= [('Content-type','image/png'),('ETag',etag)]
     start_response(status,response_header)
     return [bytes]
+
+# Players requesting the same image at the same moment share one render
+application= singleflight.wrap(application)
+# Serve the image as WebP to players that accept that (made once per image)
+application= encoder.negotiate(application, lossless=div_webp_lossless, quality=div_webp_quality)
+# Answer players that have the image already (ETag or time) with 304 Not Modified
+application= conditional.wrap(application)
    
 if __name__ == "__main__":
     name_date_list,rejects= readXLSX(r"ehv-birthdays.xlsx")
     md_namedates_dict= convert(name_date_list)
     image= table2Img(md_namedates_dict,log)
-    with io.BytesIO() as memfile:
-        image.save(memfile, format="png")
-        bytes= memfile.getvalue()
+    bytes= encoder.png(image, palette=div_png_palette, compress_level=div_png_level, optimize=div_png_optimize)
     #print( bytes )
     
 
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+# conditional.py - Shared HTTP validators (ETag, Last-Modified) and "304 Not Modified" responses for the scripts
+#   wrap() gives every "200 OK" response of a script an ETag (the hash of the body, unless the script set one itself),
+#   a Last-Modified (the moment that ETag was first served for the query string) and "Cache-Control: no-cache"
+#   (players revalidate on every poll, which is cheap). When the ETag of a request's If-None-Match still matches
+#   (or, without If-None-Match, when If-Modified-Since is not before Last-Modified) the player gets "304 Not Modified",
+#   a few hundred bytes instead of the whole channel or image.
+#   A script whose output has volatile decorations (e.g. a time stamp footer) sets its own ETag, made with etag() from
+#   the content that matters (e.g. the departures), so that a new time stamp alone does not make the players download again.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/conditional.py) and wrap the application at the end of a script
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import conditional
+#   application = conditional.wrap(application) # outermost, after scheduler.register and encoder.negotiate
+# and optionally let the application set its own validator
+#   start_response( '200 OK', [('Content-type','image/png'), ('ETag',conditional.etag((stops,tables)))] )
+
+
+import time
+import hashlib
+import threading
+import collections
+import email.utils
+import singleflight
+
+
+# Diversity settings
+div_cachecontrol = "no-cache"                   # default Cache-Control of the responses (players must revalidate, e.g. "max-age=60" would not)
+div_maxkeys = 256                               # maximum number of query strings for which Last-Modified is kept (least recently used are dropped)
+
+
+# Returns a (strong) ETag for `content`: bytes, or any value whose repr() is stable (e.g. tuples, lists, dicts of strings and numbers)
+def etag(content) :
+  data = content if isinstance(content,bytes) else repr(content).encode("utf-8")
+  return '"%s"' % hashlib.sha1(data).hexdigest()[:32]
+
+
+# Returns True when HTTP If-None-Match header `header` lists `tag` (or is "*"); weak tags (W/"...") compare on their value
+def matches(header,tag) :
+  if header.strip()=="*" : return True
+  tags = [t.strip() for t in header.split(",")]
+  return any( (t[2:] if t.startswith("W/") else t)==tag for t in tags )
+
+
+# Returns True when HTTP If-Modified-Since header `header` is not before `modified` (seconds since epoch)
+def unmodified(header,modified) :
+  try :
+    since = email.utils.parsedate_to_datetime(header).timestamp()
+  except (TypeError,ValueError,IndexError) :
+    return False
+  return since >= int(modified)
+
+
+# Returns a WSGI application that passes requests to WSGI application `app`, adds validators to its "200 OK" responses,
+# and answers requests for unchanged responses with "304 Not Modified"
+def wrap(app,cachecontrol=div_cachecontrol) :
+  seen = collections.OrderedDict() # (query string,content type) -> (etag,first served)
+  lock = threading.Lock()
+  def application(environ,start_response) :
+    status,headers,body = singleflight.call(app,environ)
+    if not status.startswith("200") :
+      start_response(status,headers)
+      return [body]
+    fields = {k.lower():v for k,v in headers}
+    tag = fields.get("etag") or etag(body)
+    key = (environ.get("QUERY_STRING",""), fields.get("content-type"))
+    with lock :
+      previous = seen.get(key)
+      modified = previous[1] if previous is not None and previous[0]==tag else time.time()
+      seen[key] = (tag,modified)
+      seen.move_to_end(key)
+      while len(seen) > div_maxkeys : seen.popitem(last=False)
+    validators = [("ETag",tag), ("Last-Modified",email.utils.formatdate(modified,usegmt=True)), ("Cache-Control",cachecontrol)]
+    headers = [(k,v) for k,v in headers if k.lower() not in ("etag","last-modified","cache-control")] + validators
+    if "HTTP_IF_NONE_MATCH" in environ :
+      fresh = matches(environ["HTTP_IF_NONE_MATCH"],tag)
+    else :
+      fresh = "HTTP_IF_MODIFIED_SINCE" in environ and unmodified(environ["HTTP_IF_MODIFIED_SINCE"],modified)
+    if fresh :
+      start_response("304 Not Modified", [(k,v) for k,v in headers if k.lower() not in ("content-type","content-length")])
+      return [b""]
+    start_response(status,headers)
+    return [body]
+  return application
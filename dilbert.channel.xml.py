@@ -29,10 +29,13 @@ version = "v3"
 
 
 import sys
+import os
 import ntpath
-import requests
 from xml.dom import minidom
 
+# Import fetch (shared upstream cache), scheduler (background refresh), singleflight (coalesced requests) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fetch, scheduler, singleflight, conditional
+
 
 # Parse the dilbert web page and return a tuple (title, desc, imgurl) for the cartoon.
 # Returns None on parsing error.
@@ -61,6 +64,11 @@ def parse(page):
 
 
 
+# Parses the dilbert web page in response `resp` (memoized via fetch.memo, so only redone when the page changed)
+def parseresp(resp):
+    return parse(resp.text)
+
+
 # Converts a triple (title, desc, imgurl) to an rss (xml) string
 def triple2rss(triple):
     return '<?xml version="1.0" encoding="utf-8"?>\r\n'\
@@ -85,11 +93,12 @@ def application(environ, start_response):
         url= 'https://dilbert.com'
         log+= f'url    : {url}\r\n'
         # load web page
-        resp= requests.get(url)
+        resp= fetch.get(url, ttl=600)
         log+=  'page   : {0}\r\n       : ...\r\n'.format(resp.text[0:500].replace("\n","\n       : "))
         # extract the triple (title, desc, imgurl) for the cartoon.
-        triple= parse(resp.text)
-        if triple==None: triple=('Dilbert','Parse error','https://assets.amuniversal.com/583d3560af230132cfe8005056a9545d')
+        triple= fetch.memo(resp, parseresp)
+        failed= triple==None
+        if failed: triple=('Dilbert','Parse error','https://assets.amuniversal.com/583d3560af230132cfe8005056a9545d')
         log+= f'title  : "{triple[0]}"\r\n' 
         log+= f'desc   : "{triple[1]}"\r\n' 
         log+= f'imgurl : "{triple[2]}"\r\n' 
@@ -97,7 +106,8 @@ def application(environ, start_response):
         rss= triple2rss(triple)
         log+=  'rss    : {0}\r\n'.format(rss.replace("\n","\n       : "))
         # raise Exception('Aborted for testing') # Uncomment for testing
-        start_response( '200 OK' , [('Content-type','text/xml')] )
+        # An error triple is served, but marked so that the scheduler keeps the previous good channel
+        start_response( '200 OK' , [('Content-type','text/xml')] + ([scheduler.fallback] if failed else []) )
         return [rss.encode()]
     except Exception as error:
         log+= 'ERROR  : %s\r\n' % str(error)
@@ -105,10 +115,16 @@ def application(environ, start_response):
         return [ log.encode('utf-8') ]
        
 
+# Keep the channel warm in the background (dilbert changes once a day)
+application= scheduler.register(singleflight.wrap(application), minimum=600, maximum=6*3600)
+# Answer players that have the channel already (ETag or time) with 304 Not Modified
+application= conditional.wrap(application)
+
+
 # The entry point for commandline test
 if __name__ == "__main__":
     url= 'https://dilbert.com'
-    resp= requests.get(url)
+    resp= fetch.get(url)
     triple= parse(resp.text)
     rss= triple2rss(triple)
     print(rss)
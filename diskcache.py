@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+
+# diskcache.py - Shared on-disk cache for proxied files (e.g. the sharepoint images of sp.py)
+#   The content is stored by its hash (objects/<sha256>), so the same picture under two urls is stored once.
+#   An index (index.json) maps each url to its content hash and meta data (mime type, ETag, Last-Modified),
+#   and records when the url was last checked with the origin and last used.
+#   When the total size exceeds `maxbytes`, the least recently used urls are evicted.
+#   When a cached url is older than `ttl`, it is still served, but revalidated in the background.
+#   Several processes (e.g. mod_wsgi daemons) may share a cache directory. Each process keeps its own changes to the index,
+#   and merges them into index.json under a file lock (re-reading what the other processes wrote). Content is only
+#   deleted when, in that merged index, no url refers to it anymore.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/diskcache.py) and import it with
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import diskcache
+#   cache= diskcache.Cache( os.path.join(diskcache.div_dir,'sp') )
+
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import collections
+try :
+  import fcntl # optional, see FileLock
+except ImportError :
+  fcntl = None
+
+
+# Diversity settings
+div_dir = os.path.join(tempfile.gettempdir(),"narrowcast") # parent directory for the caches (must be writable by the webserver)
+div_maxbytes = 500*1000*1000                    # default maximum total size of the cached content
+div_ttl = 3600                                  # default seconds before a cached url is revalidated with the origin
+div_saveused = 600                              # seconds after which the use of urls (for eviction) is written to the index, when nothing else is
+
+
+# An exclusive lock on file `path`, shared by the processes of the webserver, held in a with block.
+# It is reentrant, but not thread safe: the thread lock of the cache must be held. Without fcntl (Windows) it does nothing.
+class FileLock :
+  def __init__(self,path) :
+    self.path = path
+    self.depth = 0
+    self.file = None
+
+  def __enter__(self) :
+    if self.depth==0 :
+      self.file = open(self.path,"a")
+      if fcntl is not None : fcntl.flock(self.file, fcntl.LOCK_EX)
+    self.depth += 1
+    return self
+
+  def __exit__(self,*exc) :
+    self.depth -= 1
+    if self.depth==0 : self.file.close() # releases the lock
+
+
+class Cache :
+
+  # Creates (or opens) the cache in directory `dir`
+  def __init__(self,dir,maxbytes=div_maxbytes,ttl=div_ttl) :
+    self.dir = dir
+    self.maxbytes = maxbytes
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.filelock = FileLock(os.path.join(dir,"lock"))
+    self.revalidating = set()
+    self.index = {}
+    self.changes = {} # url -> changed fields of its entry (all of them when this process stored it), not saved yet
+    self.loaded = None # modification time of index.json when it was read
+    self.saved = time.time()
+    os.makedirs(os.path.join(dir,"objects"), exist_ok=True)
+    with self.lock : self.load()
+
+  # Returns the path of the file with content `hash`
+  def path(self,hash) :
+    return os.path.join(self.dir,"objects",hash)
+
+  # Reads the index from disk (as the other processes wrote it) and applies the changes of this process that were not
+  # saved yet. Returns the hashes that this process stopped referring to (its urls now have other content) (lock must be held)
+  def load(self) :
+    released = set()
+    try :
+      with open(os.path.join(self.dir,"index.json")) as file :
+        self.loaded = os.fstat(file.fileno()).st_mtime_ns
+        index = json.load(file)
+    except (OSError,ValueError) :
+      index = {}
+    for url,fields in self.changes.items() :
+      if "hash" in fields : # stored by this process
+        if url in index and index[url]["hash"]!=fields["hash"] : released.add(index[url]["hash"])
+        index[url] = dict(fields)
+      elif url in index : # checked or used by this process
+        index[url].update(fields)
+    self.index = index
+    return released
+
+  # Merges the changes of this process into the index on disk: under the file lock the index is re-read, urls are
+  # evicted, and the result is written (atomically, other processes may read it without the lock) (lock must be held)
+  def save(self) :
+    with self.filelock :
+      released = self.load()
+      self.evict(released)
+      fd,tmp = tempfile.mkstemp(dir=self.dir)
+      with os.fdopen(fd,"w") as file :
+        json.dump(self.index,file)
+      os.replace(tmp,os.path.join(self.dir,"index.json"))
+      self.loaded = os.stat(os.path.join(self.dir,"index.json")).st_mtime_ns
+      self.changes = {}
+      self.saved = time.time()
+
+  # Records a change of this process to the entry of `url` (see save) (lock must be held)
+  def change(self,url,**fields) :
+    self.index[url].update(fields)
+    self.changes.setdefault(url,{}).update(fields)
+
+  # Returns the entry (a dict with hash, size, mime, etag, modified, checked, used) for `url`, or None.
+  def lookup(self,url) :
+    with self.lock :
+      try :
+        if os.stat(os.path.join(self.dir,"index.json")).st_mtime_ns!=self.loaded : self.load() # written by another process
+      except OSError :
+        pass
+      entry = self.index.get(url)
+      if entry is None : return None
+      if not os.path.exists(self.path(entry["hash"])) : # evicted by another process
+        del self.index[url]
+        return None
+      self.change(url, used=time.time())
+      if time.time() - self.saved > div_saveused : self.save()
+      return dict(entry)
+
+  # Returns True when `entry` should be revalidated with the origin
+  def stale(self,entry) :
+    return time.time() - entry["checked"] > self.ttl
+
+  # Stores the file `tmp` (with content `hash` and `size`) for `url` with `meta` (mime, etag, modified).
+  # Returns the stored entry (see lookup), or None when it did not fit in `maxbytes` (it was evicted right away).
+  def commit(self,url,tmp,hash,size,meta) :
+    with self.lock, self.filelock : # no other process deletes the content between its check and the index
+      path = self.path(hash)
+      if os.path.exists(path) :
+        os.remove(tmp)
+      else :
+        os.replace(tmp,path)
+      now = time.time()
+      self.index[url] = {}
+      self.change(url, **dict(meta, hash=hash, size=size, checked=now, used=now))
+      self.save()
+      entry = self.index.get(url)
+      return dict(entry) if entry is not None and entry["hash"]==hash else None
+
+  # Stores `content` for `url` with `meta` (mime, etag, modified). Returns the stored entry, or None (see commit).
+  def put(self,url,content,meta) :
+    fd,tmp = tempfile.mkstemp(dir=self.dir)
+    with os.fdopen(fd,"wb") as file :
+      file.write(content)
+    return self.commit(url,tmp,hashlib.sha256(content).hexdigest(),len(content),meta)
+
+  # Marks `url` as just checked with the origin (which reported it unchanged)
+  def touch(self,url) :
+    with self.lock :
+      if url in self.index :
+        self.change(url, checked=time.time())
+        self.save()
+
+  # Drops least recently used urls (of all processes) until the content fits in `maxbytes`, and deletes the content that
+  # this process stopped referring to (`released`, plus that of the dropped urls) once no url refers to it anymore.
+  # The index was just merged, so the urls of the other processes are counted too (lock and file lock must be held)
+  def evict(self,released) :
+    refs = collections.Counter(entry["hash"] for entry in self.index.values())
+    sizes = {entry["hash"]:entry["size"] for entry in self.index.values()}
+    total = sum(sizes.values())
+    for url,entry in sorted(self.index.items(), key=lambda item:item[1]["used"]) :
+      if total <= self.maxbytes : break
+      del self.index[url]
+      released.add(entry["hash"])
+      refs[entry["hash"]] -= 1
+      if refs[entry["hash"]]==0 : total -= sizes[entry["hash"]]
+    for hash in released :
+      if refs[hash]==0 :
+        try :
+          os.remove(self.path(hash))
+        except OSError :
+          pass
+
+  # Calls `load(url)` in a background thread (once per url at a time).
+  # It should return (content,meta) when the content changed, or None when it did not.
+  def revalidate(self,url,load) :
+    with self.lock :
+      if url in self.revalidating : return
+      self.revalidating.add(url)
+    def run() :
+      try :
+        result = load(url)
+        if result is None :
+          self.touch(url)
+        else :
+          self.put(url,*result)
+      except Exception :
+        pass # keep serving the cached content
+      finally :
+        with self.lock : self.revalidating.discard(url)
+    threading.Thread(target=run, daemon=True).start()
+
+  # Returns an iterable over the chunks of `body` (which is closed by close()), that stores the content for `url` with `meta`
+  # (mime, etag, modified) once all chunks were passed. Incomplete content (e.g. a closed connection) is not stored.
+  def tee(self,url,meta,body) :
+    return Tee(self,url,meta,body)
+
+
+# An iterable over the chunks of `body` that also writes them to the cache (see Cache.tee)
+class Tee :
+  def __init__(self,cache,url,meta,body) :
+    self.cache = cache
+    self.url = url
+    self.meta = meta
+    self.body = body
+    self.chunks = None
+
+  def __iter__(self) :
+    self.chunks = self.generate()
+    return self.chunks
+
+  def generate(self) :
+    fd,tmp = tempfile.mkstemp(dir=self.cache.dir)
+    hash = hashlib.sha256()
+    size = 0
+    complete = False
+    try :
+      with os.fdopen(fd,"wb") as file :
+        for chunk in self.body :
+          file.write(chunk)
+          hash.update(chunk)
+          size += len(chunk)
+          yield chunk
+      complete = True
+    finally :
+      if complete :
+        self.cache.commit(self.url,tmp,hash.hexdigest(),size,self.meta)
+      else :
+        os.remove(tmp)
+
+  def close(self) :
+    if self.chunks is not None : self.chunks.close()
+    self.body.close()
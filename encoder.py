@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+# encoder.py - Shared encoding of the generated images of the .png.py scripts
+#   The scripts draw tables and charts with a handful of flat colors (plus the antialiased edges of the texts),
+#   on a full RGB(A) image. Saved as is, every pixel costs 3 or 4 bytes before compression.
+#   png() first reduces such an image to a palette (P mode, transparency kept in the palette), which is one byte per pixel:
+#   with at most 256 colors the palette holds exactly those colors (lossless, alpha in the tRNS chunk), with at most
+#   `div_maxcolors` colors an adaptive palette is made (fast octree: nearby colors are merged, so colors shift a little),
+#   and with more colors (e.g. a photo) the image is kept as is.
+#   The zlib effort is a choice per endpoint: `compress_level` (0-9) and `optimize` (extra effort for the smallest file).
+#   negotiate() wraps the application of a script: when a player accepts WebP (its Accept header lists image/webp),
+#   an image response is re-encoded as WebP (lossless, or lossy for photos), with `Vary: Accept` so that caches keep both.
+#   The WebP is made once per image: it is remembered by the hash of the PNG (or other original) it was made from.
+#   An ETag that the application set (see conditional.py) gets a "-webp" suffix on the WebP, it is another representation.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/encoder.py) and import it with
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import encoder
+#   bytes= encoder.png( image, compress_level=div_png_level, optimize=div_png_optimize )
+#   application= encoder.negotiate( application, lossless=True ) # at the end of the script, around the registered application
+
+
+import io
+import hashlib
+import threading
+import collections
+from PIL import Image, features
+import singleflight
+
+
+# Diversity settings
+div_palette = True                              # default for reducing an image to a palette (when its colors allow it)
+div_maxcolors = 8192                            # images with more colors are not reduced (photos would get banding)
+div_compress_level = 6                          # default zlib compression level (1 is fastest, 9 is smallest)
+div_optimize = False                            # default for the extra effort (slow) to find the smallest file
+div_webp_quality = 80                           # default WebP quality (lossy), or effort (lossless), 0-100
+div_webp_method = 4                             # WebP encoder effort, 0 (fast) to 6 (small)
+div_webp_maxbytes = 64*1000*1000                # maximum total size of the remembered WebP images (least recently used are dropped)
+div_webp_mimes = ["image/png", "image/jpeg", "image/bmp"] # response types that are re-encoded (not gif, it may be animated)
+
+
+# Returns `image` (RGB or RGBA) as a palette image with exactly `colors` (at most 256, as getcolors() lists them);
+# the alpha of an RGBA image goes to the transparency of the palette.
+# The pixels get their palette index band by band with point() and a lookup table (in C, no loop per pixel): the index of
+# the combination of the bands so far and the value of the next band make a 16 bit key, which the table maps to the index
+# of the combination with that band. Once the combinations tell all colors apart (often already red and green, and a
+# single alpha never needs a look), the remaining bands are not looked at.
+def exact(image,colors) :
+  index = image.getchannel(0) # for the first band, the index of a combination (its value) is the value
+  combos = [(value,) for value in range(256)] # index -> combination of the bands so far
+  n = 1
+  while len({color[:n] for color in colors}) < len(colors) :
+    indexes = {combo:i for i,combo in enumerate(combos)}
+    combos = sorted({color[:n+1] for color in colors})
+    table = [0]*65536
+    for i,combo in enumerate(combos) : table[ indexes[combo[:-1]]*256 + combo[-1] ] = i
+    # Interleaved as LA, the two bytes of a pixel are the little endian 16 bit key value+256*index
+    key = Image.frombytes("I", image.size, Image.merge("LA",(image.getchannel(n),index)).tobytes(), "raw", "I;16")
+    index = key.point(table,"L")
+    n += 1
+  byprefix = {color[:n]:color for color in colors}
+  palette = [byprefix.get(combo,colors[0]) for combo in combos] # the unused indexes (of the first band) get any color
+  result = Image.frombytes("P", image.size, index.tobytes())
+  result.putpalette(b"".join(bytes(color[:3]) for color in palette))
+  if image.mode=="RGBA" and any(color[3]!=255 for color in colors) : result.info["transparency"] = bytes(color[3] for color in palette)
+  return result
+
+
+# Returns `image` reduced to a palette image when it has at most `maxcolors` colors, otherwise `image` itself
+def palettize(image,maxcolors=div_maxcolors) :
+  if image.mode not in ("RGB","RGBA") : return image
+  colors = image.getcolors(256)
+  if colors is not None : return exact(image,[color for count,color in colors]) # lossless
+  if image.getcolors(maxcolors) is None : return image
+  # Fast octree keeps alpha in the palette, but merges nearby colors (not lossless)
+  return image.quantize(256, method=Image.FASTOCTREE, dither=Image.NONE)
+
+
+# Returns `image` encoded as PNG (bytes), as a palette image when `palette` is set and its colors allow it
+def png(image,palette=div_palette,compress_level=div_compress_level,optimize=div_optimize) :
+  if palette : image = palettize(image)
+  with io.BytesIO() as memfile :
+    image.save(memfile, format="png", compress_level=compress_level, optimize=optimize)
+    return memfile.getvalue()
+
+
+# Returns True when HTTP Accept header `accept` lists image/webp (with a quality above 0); */* does not count, old players send that too
+def accepts_webp(accept) :
+  for part in accept.split(",") :
+    mime,*params = [p.strip() for p in part.split(";")]
+    if mime.lower()!="image/webp" : continue
+    for param in params :
+      name,_,value = param.partition("=")
+      if name.strip()=="q" :
+        try :
+          return float(value)>0
+        except ValueError :
+          return False
+    return True
+  return False
+
+
+# Returns image file `body` (of type `mime`) encoded as WebP (bytes). A jpeg is always encoded lossy: it has lost its exact pixels already.
+def webp(body,mime,lossless,quality=div_webp_quality,method=div_webp_method) :
+  image = Image.open(io.BytesIO(body))
+  image = image.convert("RGBA" if image.mode in ("RGBA","LA","PA") or "transparency" in image.info else "RGB")
+  with io.BytesIO() as memfile :
+    image.save(memfile, format="webp", lossless=lossless and mime!="image/jpeg", quality=quality, method=method)
+    return memfile.getvalue()
+
+
+# The WebP images, keyed by the hash of their original (None when the WebP was not smaller); ordered for least-recently-used eviction
+webps = collections.OrderedDict()
+webps_lock = threading.Lock()
+webps_bytes = 0
+
+
+# Returns the WebP for image file `body` (see webp), made once per original; None when the WebP is not smaller than `body`
+def webp_once(body,mime,lossless,quality,method) :
+  global webps_bytes
+  key = (hashlib.sha1(body).digest(),lossless,quality,method)
+  with webps_lock :
+    if key in webps :
+      webps.move_to_end(key)
+      return webps[key]
+  data = webp(body,mime,lossless,quality,method)
+  if len(data) >= len(body) : data = None
+  with webps_lock :
+    if key not in webps :
+      webps[key] = data
+      webps_bytes += len(data or b"")
+      while webps_bytes > div_webp_maxbytes :
+        old = webps.popitem(last=False)[1]
+        webps_bytes -= len(old or b"")
+  return data
+
+
+# Returns a WSGI application that passes requests to WSGI application `app`, and serves its image responses
+# as WebP to players that accept that (lossless when `lossless` is set, else lossy at `quality`)
+def negotiate(app,lossless=True,quality=div_webp_quality,method=div_webp_method) :
+  if not features.check("webp") : return app # Pillow without WebP support: keep serving the originals
+  def application(environ,start_response) :
+    status,headers,body = singleflight.call(app,environ)
+    mime = next( (v.split(";")[0].strip().lower() for k,v in headers if k.lower()=="content-type"), "" )
+    if mime in div_webp_mimes :
+      headers = [(k,v) for k,v in headers if k.lower() not in ("vary","content-length")] + [("Vary","Accept")]
+      if status.startswith("200") and accepts_webp(environ.get("HTTP_ACCEPT","")) :
+        data = webp_once(body,mime,lossless,quality,method)
+        if data is not None :
+          body = data
+          headers = [(k,v) for k,v in headers if k.lower()!="content-type"] + [("Content-type","image/webp")]
+          headers = [(k,v[:-1]+'-webp"' if k.lower()=="etag" else v) for k,v in headers] # an ETag set by the application is for the original
+    start_response(status,headers)
+    return [body]
+  return application
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+# fetch.py - Shared upstream fetch layer for the bridge scripts
+#   Keeps the last response per url in memory. Within its time-to-live a response is served from memory,
+#   after that it is revalidated with the origin (If-None-Match/If-Modified-Since), so that an unchanged
+#   feed only costs a "304 Not Modified". Results derived from a response (e.g. a parsed feed) can be
+#   memoized on that response with memo(), so they survive as long as the origin content is unchanged.
+#   While the scheduler refreshes (see scheduler.py), cached responses are always revalidated.
+#   All requests go over one pooled keep-alive session per host (see session()), so that the TCP+TLS
+#   handshake is not repeated for every request; load() uses that session without caching.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/fetch.py) and import it with
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fetch
+#   resp= fetch.get('https://xkcd.com/rss.xml', ttl=600)
+#   resp= fetch.load('https://v0.ovapi.nl/stopareacode/ehvhts')
+
+
+import time
+import threading
+import collections
+import urllib.parse
+import requests
+import requests.adapters
+import scheduler
+
+
+# Diversity settings
+div_ttl = 300                                   # default time-to-live (seconds) of a cached response
+div_timeout = 30                                # timeout (seconds) for a request to the origin
+div_maxurls = 64                                # maximum number of urls kept in the cache (least recently used are dropped)
+div_poolsize = 4                                # default number of keep-alive connections per host
+div_poolsizes = {                               # number of keep-alive connections for specific hosts
+  "thingspeak.com": 6,                          #   thingspeak.png fetches six channels in one go
+  "cdn.knmi.nl": 4,                             #   multi.png fetches several maps in one go
+}
+
+
+# The pooled sessions, one per scheme+host
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+# Returns the shared session for the host of `url`.
+# The session keeps up to `div_poolsizes[host]` (or `div_poolsize`) connections to that host alive.
+def session(url) :
+  parts = urllib.parse.urlsplit(url)
+  k = f"{parts.scheme}://{parts.netloc}"
+  with sessions_lock :
+    s = sessions.get(k)
+    if s is None :
+      size = div_poolsizes.get(parts.hostname,div_poolsize)
+      s = requests.Session()
+      s.mount( k, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size) )
+      sessions[k] = s
+  return s
+
+
+# Returns the response for `url` (not cached), loaded over the shared session for its host.
+# Arguments (e.g. `headers`) are passed to requests.
+def load(url,**kwargs) :
+  kwargs.setdefault("timeout",div_timeout)
+  return session(url).get(url,**kwargs)
+
+
+# The cache maps a key (url plus request headers) to an Entry; it is ordered for least-recently-used eviction
+cache = collections.OrderedDict()
+cache_lock = threading.Lock()
+
+
+# A cached response, with the moment it needs to be revalidated
+class Entry :
+  def __init__(self,response,ttl) :
+    self.response = response
+    self.expires = time.time() + ttl
+
+
+# Returns the key in the cache for `url` fetched with request `headers`
+def key(url,headers) :
+  if not headers : return url
+  return url + "|" + "|".join( f"{k}:{v}" for k,v in sorted(headers.items()) )
+
+
+# Returns the (cached) response for `url`, loaded with extra request `headers`.
+# A cached response younger than `ttl` seconds is returned without contacting the origin (unless the scheduler is refreshing).
+# An older one is revalidated; if the origin answers "304 Not Modified" the cached response is kept.
+# If the origin fails while we have a cached response, the (stale) cached response is returned.
+# Only "200 OK" responses are cached; other responses are returned as is.
+def get(url,ttl=div_ttl,headers=None) :
+  k = key(url,headers)
+  with cache_lock :
+    entry = cache.get(k)
+    if entry is not None : cache.move_to_end(k)
+  if entry is not None and time.time() < entry.expires and not scheduler.refreshing() :
+    return entry.response
+  # Build the (conditional) request
+  reqheaders = dict(headers) if headers else {}
+  if entry is not None :
+    etag = entry.response.headers.get("ETag")
+    if etag : reqheaders["If-None-Match"] = etag
+    modified = entry.response.headers.get("Last-Modified")
+    if modified : reqheaders["If-Modified-Since"] = modified
+  try :
+    resp = load(url, headers=reqheaders)
+  except requests.RequestException :
+    if entry is None : raise
+    return entry.response # stale, but better than nothing
+  if resp.status_code==304 and entry is not None :
+    entry.expires = time.time() + ttl
+    return entry.response
+  if resp.status_code!=200 :
+    if entry is not None and resp.status_code>=500 : return entry.response
+    return resp
+  resp.content # force the body to be read, the response object is shared between requests
+  with cache_lock :
+    cache[k] = Entry(resp,ttl)
+    cache.move_to_end(k)
+    while len(cache) > div_maxurls : cache.popitem(last=False)
+  return resp
+
+
+# Returns `func(resp)`, computed once per response object.
+# Since get() returns the same response object as long as the origin content is unchanged,
+# this avoids re-parsing a feed that did not change.
+def memo(resp,func) :
+  with cache_lock :
+    memos = resp.__dict__.setdefault("memos",{})
+    if func in memos : return memos[func]
+  result = func(resp)
+  with cache_lock :
+    memos[func] = result
+  return result
+
+
+# Drops all cached responses
+def clear() :
+  with cache_lock :
+    cache.clear()
+
+
+# The entry point for command line test
+if __name__ == "__main__":
+  url = "https://xkcd.com/rss.xml"
+  for i in range(3) :
+    t0 = time.time()
+    resp = get(url,ttl=0 if i==2 else div_ttl)
+    print( f"{i}: {resp.status_code} {len(resp.content)} bytes in {time.time()-t0:.3f}s" )
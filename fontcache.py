@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+# fontcache.py - Shared in-process cache of the fonts of the image scripts
+#   Loading a TrueType font reads and parses the font file; the image scripts load the same few fonts on every request.
+#   truetype() returns the loaded font per (path,size), so each font is only loaded once per process.
+#   When more than `div_maxfonts` fonts are loaded, the least recently used one is dropped.
+#   A Pillow font has no state that changes while drawing, so one font object can be shared by all threads.
+#   textsize() measures a (single line) text from its bounding box, and remembers the result per (font,size,text),
+#   since the same labels (stop names, line numbers, "track 3 Sprinter") are measured on every request.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/fontcache.py) and import it with
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fontcache
+#   font= fontcache.truetype( getFontPath("ARIAL.TTF"), 24 )
+#   sizex,sizey= fontcache.textsize( "Eindhoven", font )
+
+
+import threading
+import collections
+from PIL import ImageFont
+
+
+# Diversity settings
+div_maxfonts = 32                               # maximum number of fonts kept loaded (least recently used are dropped)
+div_maxtexts = 4096                             # maximum number of text sizes kept (least recently used are dropped)
+
+
+# The cache maps (path,size) to a font; it is ordered for least-recently-used eviction
+fonts = collections.OrderedDict()
+fonts_lock = threading.Lock()
+
+
+# Returns the font in file `path` at `size` (like ImageFont.truetype), loaded once
+def truetype(path,size) :
+  key = (path,size)
+  with fonts_lock :
+    font = fonts.get(key)
+    if font is not None :
+      fonts.move_to_end(key)
+      return font
+  font = ImageFont.truetype(path,size) # outside the lock, other fonts can be served meanwhile
+  with fonts_lock :
+    fonts[key] = font
+    fonts.move_to_end(key)
+    while len(fonts) > div_maxfonts : fonts.popitem(last=False)
+  return font
+
+
+# The cache maps (font file,size,text) to the size of the text; it is ordered for least-recently-used eviction
+sizes = collections.OrderedDict()
+sizes_lock = threading.Lock()
+
+
+# Returns (width,height) of single line `text` in `font`, like the ImageDraw.textsize() that Pillow 10 removed:
+# the right and bottom of the bounding box of the text drawn at (0,0), so including the offset of the first glyph
+def textsize(text,font) :
+  key = (getattr(font,"path",id(font)), getattr(font,"size",None), text)
+  with sizes_lock :
+    size = sizes.get(key)
+    if size is not None :
+      sizes.move_to_end(key)
+      return size
+  left,top,right,bottom = font.getbbox(text)
+  size = (right,bottom)
+  with sizes_lock :
+    sizes[key] = size
+    while len(sizes) > div_maxtexts : sizes.popitem(last=False)
+  return size
+
+
+# Drops all loaded fonts and measured texts
+def clear() :
+  with fonts_lock :
+    fonts.clear()
+  with sizes_lock :
+    sizes.clear()
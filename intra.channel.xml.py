@@ -28,8 +28,7 @@ version = "v2"
 
 
 import sys
-import requests
-import requests_ntlm
+import os
 import xml.dom.minidom
 
 #sys.setdefaultencoding('utf-8')
@@ -37,6 +36,9 @@ import xml.dom.minidom
 # Import cfg.username, cfg.password, cfg.hostname, cfg.hostip
 import sys; sys.path.append( "/var/www" ); import cfg
 
+# Import ntlmpool (authenticated keep-alive connections to sharepoint, shared with sp.py), singleflight (coalesced requests) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import ntlmpool, singleflight, conditional
+
 
 # As input needs a list of string triples (title,description,imgurl)
 # Returns an rss (xml) string [format narrowcast] with all triples.
@@ -142,8 +144,7 @@ def xml2triples(rssdata):
 
 def download():
   url= cfg.rssurl.replace(cfg.hostname,cfg.hostip) # Hack because DNS is not working
-  session = requests.Session() 
-  response = session.get(url, auth=requests_ntlm.HttpNtlmAuth(cfg.username,cfg.password), headers={'Host':cfg.hostname} ) # Hack because DNS is not working
+  response = ntlmpool.get(url) # sends 'Host: cfg.hostname', hack because DNS is not working
   if response.status_code==200: 
     rssdata= response.content.strip(b'\xef\xbb\xbf').decode('utf-8')
     rsstriples= xml2triples(rssdata)
@@ -157,6 +158,12 @@ def application(environ, start_response):
   start_response( '200 OK', [('Content-type','text/plain')] )
   return [ xml.encode('utf-8') ]
 
+
+# Players requesting the feed at the same moment share one download
+application= singleflight.wrap(application)
+# Answer players that have the channel already (ETag or time) with 304 Not Modified
+application= conditional.wrap(application)
+
   
 if __name__ == "__main__":
   xml= download()
@@ -1,67 +1,113 @@
 #!/usr/bin/python3
-# multi.py - Script to combine multiple images to one. For the moment hard wired to 3 knmi pictures
+# multi.py - Script to combine multiple images to one (in a grid). By default the 3 knmi pictures
 # 2019 jun 18  v1  Maarten Pennings  Created
 
 
+import os
+import sys
 import io
-import requests
+import hashlib
+import threading
+import urllib.parse
+import concurrent.futures
 from PIL import Image
 
+# Import fetch (pooled sessions), rendercache (shared output cache), scheduler (background refresh), singleflight (coalesced requests), encoder (WebP) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fetch, rendercache, scheduler, singleflight, encoder, conditional
 
+
+# Default images (multi.png without url= parameters)
 url1="https://cdn.knmi.nl/knmi/map/page/weer/actueel-weer/temperatuur.png"
 url2="https://cdn.knmi.nl/knmi/map/page/weer/actueel-weer/windsnelheid.png" # 569x622
 url3="https://cdn.knmi.nl/knmi/map/page/weer/actueel-weer/relvocht.png"
 
+max_urls=12 # maximum number of images in one combined image
+workers= concurrent.futures.ThreadPoolExecutor(max_urls) # the images are fetched in parallel
+
+cache_ttl=300 # seconds a combined image is served from cache (and then again while refreshing); knmi updates every 10 minutes
+cache= rendercache.Cache(cache_ttl)
+
+webp_lossless=True # the WebP (for players that accept it) is lossless; the knmi maps have flat colors
+
+# The last combined image per query, with the digests of its images: it is only combined again when an image changed
+combined= {}
+combined_lock= threading.Lock()
+
+
+# Converts the (fetched) response with an image to (digest,image); memoized per response by fetch, so an unchanged image is decoded once
+def decode( resp ) :
+  img = Image.open(io.BytesIO(resp.content))
+  img.load() # decode now (once), the image is shared between requests
+  return hashlib.sha1(resp.content).hexdigest(), img
+
 
-# Converts a list of urls to a list of images (raises exception when url get fails)
+# Converts a url to (digest,image) (raises exception when url get fails); an unchanged image only costs a "304 Not Modified"
+def load1( url ) :
+  resp= fetch.get(url, ttl=cache_ttl)
+  if resp.status_code!=200: raise Exception('Image %s failed with status %d' % (url,resp.status_code) )
+  return fetch.memo(resp,decode)
+
+
+# Converts a list of urls to a list of (digest,image), fetched in parallel (raises exception when a url get fails)
 def load( urls ) :
-  imgs= []
-  for url in urls:
-    resp= requests.get(url)
-    if resp.status_code!=200: raise Exception('Image %s failed with status %d' % (url,resp.status_code) )
-    img = Image.open(io.BytesIO(resp.content))
-    imgs.append(img)
-  return imgs
+  return list( workers.map(load1,urls) )
 
 
-# Converts a list images to a single image (all horizontally with some spacing)
-def combine(imgs):
+# Converts a list images to a single image (a grid of `cols` columns, with some spacing)
+def combine(imgs,cols):
   # Layout constants
   xmar= 32 # margin on both sides (horizontally)
   xsep= 32 # spacing between images (horizontally)
   ymar= 32 # margin on both sides (vertically)
-  # Get sizes
-  width= 0
-  height= 0
-  for img in imgs:
-    height= max(height,img.height)
-    if width>0: width+=xsep
-    width+= img.width
-  width= xmar+width+xmar
-  height= ymar+height+ymar
+  ysep= 32 # spacing between images (vertically)
+  # Get sizes: each column is as wide as its widest image, each row as high as its highest image
+  rows= (len(imgs)+cols-1)//cols
+  widths= [0]*cols
+  heights= [0]*rows
+  for i,img in enumerate(imgs):
+    widths[i%cols]= max(widths[i%cols],img.width)
+    heights[i//cols]= max(heights[i//cols],img.height)
+  width= xmar+sum(widths)+xsep*(cols-1)+xmar
+  height= ymar+sum(heights)+ysep*(rows-1)+ymar
   # Start drawing on image
   image = Image.new('RGBA', (width,height), 0x00FFFFFF ) # 100%transparent + white
   # Loop
-  x= xmar
-  y= ymar
-  for img in imgs:
+  for i,img in enumerate(imgs):
+    x= xmar+sum(widths[:i%cols])+xsep*(i%cols)
+    y= ymar+sum(heights[:i//cols])+ysep*(i//cols)
     image.paste(img,(x,y))
-    x= x+img.width+xsep
   return image
 
 
+# Converts a list of urls to png bytes of the combined image (`cols` columns)
+def urls2png(urls,cols):
+  tiles= load( urls )
+  key= (tuple(urls),cols)
+  digests= [digest for digest,img in tiles]
+  with combined_lock:
+    if key in combined and combined[key][0]==digests: return combined[key][1]
+  image= combine( [img for digest,img in tiles], cols )
+  with io.BytesIO() as memfile:
+    image.save(memfile, format="png")
+    bytes= memfile.getvalue()
+  with combined_lock:
+    combined[key]= (digests,bytes)
+    while len(combined) > cache.maxkeys: del combined[next(iter(combined))]
+  return bytes
+
+
 def application(environ, start_response):
-  log= 'SYNTAX : multi.png\r\nexample: http://192.168.1.1/multi.png\r\n\r\n'
+  log= 'SYNTAX : multi.png[?url=<url>&url=<url>...][&cols=<columns>]\r\nexample: http://192.168.1.1/multi.png\r\nexample: http://192.168.1.1/multi.png?url=https://cdn.knmi.nl/knmi/map/page/weer/actueel-weer/temperatuur.png&url=https://cdn.knmi.nl/knmi/map/page/weer/actueel-weer/relvocht.png&cols=1\r\n\r\n'
   try:
-    urls= [url1,url2,url3]
+    params= urllib.parse.parse_qs(environ.get('QUERY_STRING',''))
+    urls= params.get('url',[url1,url2,url3])
+    if len(urls)>max_urls: raise Exception('At most %d urls' % max_urls)
+    cols= int( params.get('cols',[len(urls)])[0] ) # default: all horizontally
+    if cols<1: raise Exception('cols must be at least 1')
+    cols= min(cols,len(urls))
     log+= 'urls   : %s\r\n' % ' '.join(urls)
-    imgs= load( urls )
-    log+= 'images : %s\r\n' % 'loaded'
-    image= combine( imgs )
-    log+= 'images : %s\r\n' % 'combined'
-    with io.BytesIO() as memfile:
-      image.save(memfile, format="png")
-      bytes= memfile.getvalue()
+    log+= 'cols   : %d\r\n' % cols
+    bytes= cache.get( rendercache.normalize({'urls':' '.join(urls),'cols':cols}), lambda: urls2png(urls,cols) )
     log+= 'binary : %s\r\n' % 'done'
     if False: raise Exception('Aborted for testing') # Change False to True for testing
     start_response( '200 OK', [('Content-type','image/png')] )
@@ -72,3 +118,11 @@ def application(environ, start_response):
     return [ log.encode('utf-8') ]
 
 
+# Keep the image warm in the background (knmi updates every 10 minutes)
+application= scheduler.register(singleflight.wrap(application), minimum=300, maximum=1800)
+# Serve the image as WebP to players that accept that (made once per image)
+application= encoder.negotiate(application, lossless=webp_lossless)
+# Answer players that have the image already (ETag or time) with 304 Not Modified
+application= conditional.wrap(application)
+
+
@@ -10,6 +10,8 @@ version = "v3"
 
 # You need some modules
 #   sudo python3 -m pip install pillow requests
+# and optionally (faster decoding of the bus server data)
+#   sudo python3 -m pip install orjson
 
 # To merge Python into Apache on Ubuntu:
 #   sudo apt install apache2 libapache2-mod-wsgi-py3  # for python3
@@ -33,14 +35,23 @@ version = "v3"
 
 
 import os
-import io
-import requests
+import sys
 import json
+import heapq
 import urllib
+import threading
+import collections
 from PIL import Image
-from PIL import ImageFont
 from PIL import ImageDraw
 from datetime import datetime
+try:
+  import orjson # optional, see decode()
+except ImportError:
+  orjson = None
+
+# Import shared helpers (fetch, rendercache, scheduler, singleflight, fontcache, encoder, conditional), they live next to this script (webserver) or one directory up (repository)
+folder = os.path.dirname(os.path.realpath(__file__))
+sys.path.extend( [folder, os.path.dirname(folder)] ); import fetch, rendercache, scheduler, singleflight, fontcache, encoder, conditional
 
 
 # URL source (also see https://drgl.nl/)
@@ -143,29 +154,77 @@ div_now_fontsize=16                             # font size for server "now" tim
 div_now_fgcolor=const_color_amsgrey1            # foreground color for server "now" time stamp
 
 
+# Diversity settings: Caching of generated images
+div_cache_ttl = 30                              # seconds a generated image is served from cache (and then again while refreshing)
+div_refresh_min = 15                            # minimum seconds between background refreshes (when departures keep changing)
+div_refresh_max = 120                           # maximum seconds between background refreshes (when departures do not change)
+div_maxcanvases = 16                            # maximum number of retained canvases (one per stops, maxrow, lowlight and mapname)
+
+
+# Diversity settings: Encoding of generated image
+div_png_palette = True                          # encode the image with a palette (one byte per pixel) when its colors allow it
+div_png_level = 6                               # zlib compression level of the png (1 is fastest, 9 is smallest); rendered every few seconds
+div_png_optimize = False                        # extra (slow) effort to find the smallest png
+div_webp_lossless = True                        # WebP (for players that accept it) is lossless, or lossy at div_webp_quality
+div_webp_quality = 80                           # WebP quality (lossy) or effort (lossless), 0-100
+
+
+# Generated images, keyed by normalized query string
+cache = rendercache.Cache(div_cache_ttl)
+
+# The log of the request or render in progress, one per thread: renders also run in the background threads of rendercache and scheduler
+local = threading.local()
+
+
 # Prepend the path of this script to filename to make it an absolute path
 def getPath(filename):
-  global log
   folder = os.path.dirname(os.path.realpath(__file__))
   path = os.path.join(folder, filename)
-  log+= f"path   : {path}\r\n"
+  local.log+= f"path   : {path}\r\n"
   return path
 
 
 # Prepend the path of this script to fonts\filename to make it an absolute path
 def getFontPath(filename):
-  global log
   folder = os.path.dirname(os.path.realpath(__file__))
   path = os.path.join(folder, os.path.join("fonts",filename))
-  log+= f"font   : {path}\r\n"
+  local.log+= f"font   : {path}\r\n"
   return path
 
 
+# The fields of the ovapi data that are used (see stops2tables); the other fields are dropped while decoding
+const_fields = {"Stop", "TimingPointName", "Passes", "DestinationName50", "LinePublicNumber", "TargetArrivalTime", "ExpectedArrivalTime"}
+
+
+# Keeps only the used fields of json object `obj`; objects without any used field (those keyed by stop and pass codes) are kept whole
+def prune(obj) :
+  if const_fields.isdisjoint(obj) : return obj
+  return { k:v for k,v in obj.items() if k in const_fields }
+
+
+# Decodes the ovapi json `data` (bytes).
+# With orjson (when installed) the whole document is decoded, that is fastest.
+# Otherwise the standard json module decodes it, and prunes each object as soon as it is decoded (object_hook),
+# so the unused fields (most of every pass) do not pile up: memory then scales with what is drawn, not with the data size.
+def decode(data) :
+  if orjson is not None : return orjson.loads(data)
+  return json.loads(data, object_hook=prune)
+
+
+# Yields (ExpectedArrivalTime,depkey,key) for the passes in `passes_dict` that are not expected before `now` (the busses that did not leave yet).
+# The depkey is the (full) TargetArrivalTime for sorting, plus the key to make it unique (two departures with same time).
+def upcoming(passes_dict,now) :
+  for key in passes_dict :
+    pass_dict = passes_dict[key]
+    if pass_dict["ExpectedArrivalTime"] < now : continue # already left
+    yield pass_dict["ExpectedArrivalTime"], pass_dict["TargetArrivalTime"] + key, key
+
+
 # Looks up the departures for bus stops and returns a dictionary of departure tables.
 #
 # `stops` is a string of comma separated "stopareacode"s, e.g. "ehvhbb,ehvhts". Find yours in https://v0.ovapi.nl/stopareacode
 # Each stopareacode is a key into the returned dictionary, giving the departure table for that stop.
-# `maxrow` limits the length of the departure list in the output image
+# `maxrow` limits the length of the departure list in the output image: the `maxrow` earliest departures that did not leave yet
 #
 # The departure table is a dictionary with `name`, `code` and a dictionary of `deps` (departures):
 #   'ehvhts': {
@@ -177,16 +236,15 @@ def getFontPath(filename):
 #     }
 #   }
 def stops2tables(stops,maxrow) :
-  global log
   # Load json data
   url = f"{const_url}/stopareacode/{stops}"
-  log+= f"request: {url}\r\n"
-  resp= requests.get(url)
-  data_json= resp.text
-  log+= f"data   : {data_json[:150]}...\r\n"
+  local.log+= f"request: {url}\r\n"
+  resp= fetch.load(url) # keep-alive connection to the bus server
+  data_json= resp.content # the raw bytes: resp.text would first convert all to a str
+  local.log+= f"data   : {data_json[:150].decode('utf-8','replace')}...\r\n"
   # Convert data to json
-  data_dict = json.loads(data_json)
-  # log+= f"dict   : {str(data_dict)[:150]}...\r\n"
+  data_dict = decode(data_json)
+  # local.log+= f"dict   : {str(data_dict)[:150]}...\r\n"
 
   # data_dict has this structure, pick the relevant fields
   #
@@ -200,40 +258,134 @@ def stops2tables(stops,maxrow) :
   #     ...
   # }
   tables = {}
+  now = datetime.now().strftime('%Y-%m-%dT%H:%M:%S') # ovapi times are local times in this format, so they compare as strings
   for stop in stops.split(",") :
     stopdata_dict = data_dict[stop]
     # Get stop name and code
     TimingPointCode = list(stopdata_dict.keys())[0] # TimingPointCode is only key of a stop
     TimingPointName = stopdata_dict[TimingPointCode]["Stop"]["TimingPointName"]
     table = { "name": TimingPointName, "code":TimingPointCode }
-    log+= f"{stop} : {TimingPointName}\r\n"
-    # Get busses that pass at this stop
-    departures = {}
+    local.log+= f"{stop} : {TimingPointName}\r\n"
+    # Get busses that pass at this stop: the `maxrow` earliest that did not leave yet, selected in one pass with a bounded heap
     passes_dict = stopdata_dict[TimingPointCode]["Passes"]
-    for key in passes_dict :
+    earliest = heapq.nsmallest( maxrow, upcoming(passes_dict,now) )
+    departures = {}
+    for ExpectedArrivalTime,depkey,key in earliest :
       pass_dict = passes_dict[key]
       DestinationName50 = pass_dict["DestinationName50"]
       LinePublicNumber = pass_dict["LinePublicNumber"]
       TargetArrivalTime = pass_dict["TargetArrivalTime"]
-      ExpectedArrivalTime = pass_dict["ExpectedArrivalTime"]
       delay = datetime.strptime(ExpectedArrivalTime,'%Y-%m-%dT%H:%M:%S') - datetime.strptime(TargetArrivalTime,'%Y-%m-%dT%H:%M:%S')
       delay = int(delay.total_seconds())
-      log+= f"           {TargetArrivalTime} +{delay}s {LinePublicNumber} {DestinationName50}\r\n"
-      depkey = TargetArrivalTime[11:19] + key # "time" for sorting and "key" to make depkey unique (two departures with same time)
+      local.log+= f"           {TargetArrivalTime} +{delay}s {LinePublicNumber} {DestinationName50}\r\n"
       departures[depkey]= {"dest":DestinationName50, "line":LinePublicNumber, "time":TargetArrivalTime, "delay":delay }
-      if len(departures)>=maxrow : break # load (and thus render) limit
     table["deps"] = dict(sorted(departures.items())) # Sort on time, this is the order in the UI
     tables[stop] = table
   return tables
 
 
+# A retained canvas, for one (stops,maxrow,lowlight,mapname): the image of the previous render and what its rows show.
+# The static layer (background, heads and map) is drawn once; a render only repaints the rows whose contents changed.
+class Canvas :
+  def __init__(self) :
+    self.lock = threading.Lock()
+    self.static = None # image with the static layer
+    self.image = None # image of the previous render: the static layer plus rows and footer
+    self.heads = None # stop names in the heads of the static layer
+    self.rows = {} # (column,row) to the contents drawn in that row (see rowcontents)
+    self.footer = None # box of the footer in the previous render
+
+
+# Retained canvases, keyed by (stops,maxrow,lowlight,mapname), least recently used are dropped
+canvases = collections.OrderedDict()
+canvases_lock = threading.Lock()
+
+
+# Returns the retained canvas for `key` (created on first use)
+def getcanvas(key) :
+  with canvases_lock :
+    canvas = canvases.get(key)
+    if canvas is None :
+      canvas = Canvas()
+      canvases[key] = canvas
+    canvases.move_to_end(key)
+    while len(canvases) > div_maxcanvases : canvases.popitem(last=False)
+  return canvas
+
+
+# Decoded map images, keyed by file name (the maps do not change while the server runs)
+maps = {}
+
+
+# Returns the (decoded) map image `mapname`
+def getmap(mapname) :
+  if mapname not in maps :
+    mapimg = Image.open(getPath(mapname))
+    mapimg.load()
+    maps[mapname] = mapimg
+  return maps[mapname]
+
+
+# Returns what a row shows for departure `dep` (None for an empty row): the time (with delay), whether it is late, line, destination and whether it is low lighted
+def rowcontents(dep,lowlight) :
+  txt = dep["time"][11:16]
+  if dep["delay"]>=60 :
+    txt += f' +{dep["delay"]//60}'
+  return (txt, dep["delay"]>=60, dep["line"], dep["dest"], lowlight in dep["dest"])
+
+
+# Draws the static layer (background, heads with the stop `names`, and map) of an image of `width` by `height`
+def drawstatic(width,height,names,mapname) :
+  image = Image.new("RGBA", (width,height), div_bgcolor )
+  draw = ImageDraw.Draw(image)
+  head_font = fontcache.truetype(getFontPath(div_head_fontname), div_head_fontsize)
+  x0 = div_x_mar # column offset - increases with every stop
+  for name in names :
+    y0 = div_y_mar
+    draw.rectangle([x0,y0,x0+div_x_head,y0+div_y_head],fill=div_head_bgcolor,outline=div_head_bgcolor)
+    draw.text( (x0+div_head_xtxt,y0+div_head_ytxt), name, div_head_fgcolor, font=head_font)
+    x0 += div_x_head + div_x_seph
+  if mapname!= None :
+    mapimg = getmap(mapname)
+    image.paste( mapimg, ( (width-mapimg.width)//2, height-mapimg.height-div_y_mar ) )
+  return image
+
+
+# Draws a row with `contents` (see rowcontents) at (`x0`,`y0`)
+def drawrow(draw,x0,y0,contents,cell_font) :
+  txt,late,line,dest,low = contents
+  # - time
+  x = x0 # cell offset - increases when moving from time/line/dest
+  draw.rectangle([x,y0,x+div_x_time,y0+div_y_row],fill=div_cell_bgcolor,outline=div_cell_bgcolor)
+  sizex,sizey= fontcache.textsize( txt, cell_font)
+  dx = (div_x_time-div_cell_xtxt-div_cell_xtxt-sizex)//2
+  draw.text( (x+div_cell_xtxt+dx,y0+div_cell_ytxt), txt, div_cell_timelate_fgcolor if late else div_cell_time_fgcolor, font=cell_font)
+  # - line
+  x += div_x_time + div_x_sepc
+  draw.rectangle([x,y0,x+div_x_line,y0+div_y_row],fill=div_cell_bgcolor,outline=div_cell_bgcolor)
+  sizex,sizey= fontcache.textsize( line, cell_font)
+  dx = (div_x_line-div_cell_xtxt-div_cell_xtxt-sizex)//2
+  draw.text( (x+div_cell_xtxt+dx,y0+div_cell_ytxt), line , div_cell_line_fgcolor, font=cell_font)
+  # - dest
+  x += div_x_line + div_x_sepc
+  draw.rectangle([x,y0,x+div_x_dest,y0+div_y_row],fill=div_cell_bgcolor,outline=div_cell_bgcolor)
+  draw.text( (x+div_cell_xtxt,y0+div_cell_ytxt), dest, div_cell_destlo_fgcolor if low else div_cell_dest_fgcolor, font=cell_font)
+
+
+# Copies box `box` of the static layer of `canvas` to its image (erasing what was drawn there)
+def restore(canvas,box) :
+  canvas.image.paste( canvas.static.crop(box), box[:2] )
+
+
 # Converts departure tables to graphical matrix, and return that image.
 # Matrix dimensions and colors are governed by the diversity settings (e.g. by div_xxx).
 # If the destination of a departure contains `lowlight`, that destination is rendered in lowlight, else in highlight.
 # Reason: low light bus stops to the area where we already are (High Tech Campus)
 # If `mapname` is not None, it should be a path to a image that will be added.
-def tables2image(tables,lowlight,mapname) :
-  global log
+# The image is drawn on the retained `canvas` (see Canvas), only the rows that changed since its previous render are drawn;
+# without `canvas` the image is drawn from scratch.
+def tables2image(tables,lowlight,mapname,canvas=None) :
+  if canvas is None : canvas = Canvas()
   # Find table with most departure rows
   maxdeps = 1 # at least "no (more) busses"
   numstops = 0
@@ -241,81 +393,63 @@ def tables2image(tables,lowlight,mapname) :
     stop = tables[skey]
     maxdeps = max(maxdeps,len(stop["deps"]))
     numstops += 1
-  log+= f"draw   : tables {numstops}, rows {maxdeps}\r\n"
+  local.log+= f"draw   : tables {numstops}, rows {maxdeps}\r\n"
   # Compute size for image to generate
   width = div_x_mar + div_x_head*numstops + div_x_seph*(numstops-1) + div_x_mar
   height = div_y_mar + div_y_head + div_y_seph + div_y_row*maxdeps + div_y_sepc*(maxdeps-1) + div_y_mar
   #  - optionally add map image
   if mapname!= None :
-    mapimg = Image.open(getPath(mapname))
-    height += div_y_sepm + mapimg.height
-  # Create image of computed size
-  image = Image.new("RGBA", (width,height), div_bgcolor )
-  draw = ImageDraw.Draw(image)
-  head_font = ImageFont.truetype(getFontPath(div_head_fontname), div_head_fontsize)
-  cell_font = ImageFont.truetype(getFontPath(div_cell_fontname), div_cell_fontsize)
-  now_font = ImageFont.truetype(getFontPath(div_now_fontname), div_now_fontsize)
-  log+= f"size   : {width}*{height}\r\n"
-  # Create a column per stop - recall stop is key in tables
-  x0 = div_x_mar # column offset - increases with every stop
-  for skey in tables :
-    stop = tables[skey]
-    # Draw head
-    y0 = div_y_mar # row offset - increases with each departure
-    draw.rectangle([x0,y0,x0+div_x_head,y0+div_y_head],fill=div_head_bgcolor,outline=div_head_bgcolor)
-    draw.text( (x0+div_head_xtxt,y0+div_head_ytxt), stop["name"], div_head_fgcolor, font=head_font)
-    # Draw departure rows
-    y0 += div_y_head + div_y_seph
-    for dkey in stop["deps"] :
-      dep = stop["deps"][dkey]
-      # - time
-      x = x0 # cell offset - increases when moving from time/line/dest
-      txt = dep["time"][11:16]
-      if dep["delay"]>=60 :
-        txt += f' +{dep["delay"]//60}'
-      draw.rectangle([x,y0,x+div_x_time,y0+div_y_row],fill=div_cell_bgcolor,outline=div_cell_bgcolor)
-      sizex,sizey= draw.textsize( txt, font=cell_font)
-      dx = (div_x_time-div_cell_xtxt-div_cell_xtxt-sizex)//2
-      draw.text( (x+div_cell_xtxt+dx,y0+div_cell_ytxt), txt, div_cell_timelate_fgcolor if dep["delay"]>=60 else div_cell_time_fgcolor, font=cell_font)
-      # - line
-      x += div_x_time + div_x_sepc
-      txt = dep["line"]
-      draw.rectangle([x,y0,x+div_x_line,y0+div_y_row],fill=div_cell_bgcolor,outline=div_cell_bgcolor)
-      sizex,sizey= draw.textsize( txt, font=cell_font)
-      dx = (div_x_line-div_cell_xtxt-div_cell_xtxt-sizex)//2
-      draw.text( (x+div_cell_xtxt+dx,y0+div_cell_ytxt), txt , div_cell_line_fgcolor, font=cell_font)
-      # - dest
-      x += div_x_line + div_x_sepc
-      txt = dep["dest"]
-      draw.rectangle([x,y0,x+div_x_dest,y0+div_y_row],fill=div_cell_bgcolor,outline=div_cell_bgcolor)
-      draw.text( (x+div_cell_xtxt,y0+div_cell_ytxt), txt, div_cell_destlo_fgcolor if lowlight in txt else div_cell_dest_fgcolor, font=cell_font)
+    height += div_y_sepm + getmap(mapname).height
+  names = [tables[skey]["name"] for skey in tables]
+  cell_font = fontcache.truetype(getFontPath(div_cell_fontname), div_cell_fontsize)
+  now_font = fontcache.truetype(getFontPath(div_now_fontname), div_now_fontsize)
+  local.log+= f"size   : {width}*{height}\r\n"
+  with canvas.lock :
+    # (Re)draw the static layer when the size or the heads changed
+    if canvas.static is None or canvas.static.size!=(width,height) or canvas.heads!=names :
+      canvas.static = drawstatic(width,height,names,mapname)
+      canvas.image = canvas.static.copy()
+      canvas.heads = names
+      canvas.rows = {}
+      canvas.footer = None
+    draw = ImageDraw.Draw(canvas.image)
+    # Repaint the rows that changed - recall stop is key in tables
+    repainted = 0
+    x0 = div_x_mar # column offset - increases with every stop
+    for col,skey in enumerate(tables) :
+      stop = tables[skey]
+      deps = list(stop["deps"].values())
+      for row in range(maxdeps) :
+        y0 = div_y_mar + div_y_head + div_y_seph + (div_y_row + div_y_sepc)*row
+        if row < len(deps) : contents = rowcontents(deps[row],lowlight)
+        elif row==0 : contents = "no (more) busses" # there was a stop, but no (more) busses because too late in the day
+        else : contents = None
+        if canvas.rows.get((col,row))==contents : continue
+        restore(canvas,(x0,y0,x0+div_x_head+1,y0+div_y_row+1))
+        if isinstance(contents,tuple) :
+          drawrow(draw,x0,y0,contents,cell_font)
+        elif contents is not None :
+          draw.rectangle([x0,y0,x0+div_x_head,y0+div_y_row],fill=div_cell_bgcolor,outline=div_cell_bgcolor)
+          draw.text( (x0+div_cell_xtxt,y0+div_cell_ytxt), contents, div_cell_destlo_fgcolor, font=cell_font)
+        canvas.rows[(col,row)] = contents
+        repainted += 1
       # Move x0 to new column
-      y0 += div_y_row + div_y_sepc
-    # Was there a stop (or no more busses because too late in the day)
-    if len(stop["deps"])==0 :
-      draw.rectangle([x0,y0,x0+div_x_head,y0+div_y_row],fill=div_cell_bgcolor,outline=div_cell_bgcolor)
-      txt = "no (more) busses"
-      draw.text( (x0+div_cell_xtxt,y0+div_cell_ytxt), txt, div_cell_destlo_fgcolor, font=cell_font)
-    # Move x0 to new column
-    x0 += div_x_head + div_x_seph
-  # Add map
-  if mapname!= None :
-    image.paste( mapimg, ( (width-mapimg.width)//2, height-mapimg.height-div_y_mar ) )
-  # Add server url, time stamp and script version
-  txt = f"from {const_url} at {datetime.now().strftime('%H:%M:%S')} by nlbus {version}"
-  sizex,sizey= draw.textsize( txt, font=now_font)
-  draw.text( (div_x_mar,height-sizey-2), txt, div_now_fgcolor, font=now_font)
-  return image
+      x0 += div_x_head + div_x_seph
+    local.log+= f"draw   : {repainted} rows repainted\r\n"
+    # Add server url, time stamp and script version
+    if canvas.footer is not None : restore(canvas,canvas.footer)
+    txt = f"from {const_url} at {datetime.now().strftime('%H:%M:%S')} by nlbus {version}"
+    sizex,sizey= fontcache.textsize( txt, now_font)
+    draw.text( (div_x_mar,height-sizey-2), txt, div_now_fgcolor, font=now_font)
+    canvas.footer = (div_x_mar,height-sizey-2,min(div_x_mar+sizex+1,width),height)
+    return canvas.image.copy() # the canvas is drawn on again by the next render
 
 
 # Converts an image to a buffer of raw bytes (to be send by http)
 def image2buffer(image) :
-  global log
-  # Save image to file in memory
-  with io.BytesIO() as memfile:
-    image.save(memfile, format="png")
-    buffer= memfile.getvalue()
-  log+= f"buffer : {len(buffer)} bytes\r\n"
+  # Save image to file in memory (with a palette, the table has few colors)
+  buffer= encoder.png(image, palette=div_png_palette, compress_level=div_png_level, optimize=div_png_optimize)
+  local.log+= f"buffer : {len(buffer)} bytes\r\n"
   return buffer
 
 
@@ -326,23 +460,29 @@ def image2buffer(image) :
 # If mapname is not none, it should be a path to a image that will be added.
 # Returns the final image buffer but also the intermediate results: tables, image, buffer.
 def main(stops,maxrow,lowlight,mapname) :
-  global log
-  log = ""
-  log += f"NL Bus creates a timetable for bus stops (in the Netherlands) - {version}\r\n"
-  log += "SYNTAX : nlbus.png?stops=ehvhbb,ehvhts&maxrow=7&lowlight=Campus&mapname=htc.png\r\n"
-  log += "         Find stops on https://v0.ovapi.nl/stopareacode, maxrow, lowlight and mapname are optional\r\n\r\n"
+  local.log = ""
+  local.log += f"NL Bus creates a timetable for bus stops (in the Netherlands) - {version}\r\n"
+  local.log += "SYNTAX : nlbus.png?stops=ehvhbb,ehvhts&maxrow=7&lowlight=Campus&mapname=htc.png\r\n"
+  local.log += "         Find stops on https://v0.ovapi.nl/stopareacode, maxrow, lowlight and mapname are optional\r\n\r\n"
   # Create table with departures for every bus stop in `stops`
   tables = stops2tables(stops,maxrow)
   # Convert table to image grid (low lighting all destinations that contain `lowlight`)
-  image = tables2image(tables,lowlight,mapname)
+  image = tables2image(tables,lowlight,mapname,getcanvas((stops,maxrow,lowlight,mapname)))
   # Convert image to bytes array
   buffer = image2buffer(image)
   return tables,image,buffer
 
 
+# Returns the png bytes for query `key` and their ETag. The ETag is made from the departures, not from the image,
+# so it leaves out the time stamp in the footer: players only download the image again when a departure changed.
+def render(key,stops,maxrow,lowlight,mapname) :
+  tables,image,buffer = main(stops,maxrow,lowlight,mapname)
+  return buffer, conditional.etag((key,tables))
+
+
 # The entry point for the webserver
 def application(environ, start_response):
-  global log
+  local.log = ""
   try:
     # Get parameters from URL
     params = urllib.parse.parse_qs(environ['QUERY_STRING'])
@@ -350,21 +490,29 @@ def application(environ, start_response):
     maxrow = params.get('maxrow', [9999])[0]   # default: "all departures" (9999 is poor man's +inf)
     lowlight = params.get('lowlight', [""])[0] # default: all destinations are lowlighted (all match "")
     mapname = params.get('mapname', [None])[0] # default: no map
-    maxrow = int(maxrow)
-    # Load actual bus data from server and convert to image
-    tables,image,buffer = main(stops,maxrow,lowlight,mapname)
+    maxrow = int(maxrow)
+    # Load actual bus data from server and convert to image (unless a recent one is cached)
+    key = rendercache.normalize( {"stops":stops, "maxrow":maxrow, "lowlight":lowlight, "mapname":mapname} )
+    buffer,etag = cache.get( key, lambda: render(key,stops,maxrow,lowlight,mapname) )
     # raise Exception("Aborted for testing") # Uncomment for testing
-    start_response("200 OK",[("Content-type","image/png")])
+    start_response("200 OK",[("Content-type","image/png"),("ETag",etag)])
     return [buffer]
   except Exception as x:
-    log+= f"\r\nERROR  : {x}\r\n"
+    local.log+= f"\r\nERROR  : {x}\r\n"
     start_response("404 ERROR",[("Content-type","text/plain")])
-    return [ log.encode("utf-8") ]
+    return [ local.log.encode("utf-8") ]
+
+
+# Keep the images warm in the background (ovapi changes every few seconds)
+application = scheduler.register(singleflight.wrap(application), minimum=div_refresh_min, maximum=div_refresh_max)
+# Serve the image as WebP to players that accept that (made once per image)
+application = encoder.negotiate(application, lossless=div_webp_lossless, quality=div_webp_quality)
+# Answer players that have the image already (ETag or time) with 304 Not Modified
+application = conditional.wrap(application)
 
 
 # The entry point for command line test
 if __name__ == "__main__":
-  global log
   try:
     stops="ehvhbb,ehvhts" # stops = "aalvbl,aalmts"
     lowlight="Campus"
@@ -373,8 +521,8 @@ if __name__ == "__main__":
     tables,image,buffer = main(stops,maxrow,lowlight,mapname)
     filename = "trial.png"
     image.save(filename)
-    log+= f"png    : saved '{filename}'\r\n"
-    print(log)
+    local.log+= f"png    : saved '{filename}'\r\n"
+    print(local.log)
   except Exception as x:
-    log+= f"\r\nERROR  : {x}\r\n"
-    print(log)
+    local.log+= f"\r\nERROR  : {x}\r\n"
+    print(local.log)
@@ -27,13 +27,15 @@ version = "v1"
 
 
 import os
-import io
-import requests
+import sys
 import json
+import threading
 from PIL import Image
-from PIL import ImageFont
 from PIL import ImageDraw 
 
+# Import fetch (pooled sessions), rendercache (shared output cache), scheduler (background refresh), singleflight (coalesced requests), fontcache (loaded fonts), encoder (palette png, WebP) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fetch, rendercache, scheduler, singleflight, fontcache, encoder, conditional
+
 
 # Drawing settings
 div_color_amsgrey1=( 70, 85, 95)      # color code for ams dark grey
@@ -57,6 +59,19 @@ div_sY=30                             # cell separation
 div_mX=30                             # x-margin for text
 div_mY=15                             # y-margin for text
 
+div_cache_ttl=60                      # seconds a generated image is served from cache (and then again while refreshing)
+div_png_palette=True                  # encode the image with a palette (one byte per pixel) when its colors allow it
+div_png_level=6                       # zlib compression level of the png (1 is fastest, 9 is smallest)
+div_png_optimize=False                # extra (slow) effort to find the smallest png
+div_webp_lossless=True                # WebP (for players that accept it) is lossless, or lossy at div_webp_quality
+div_webp_quality=80                   # WebP quality (lossy) or effort (lossless), 0-100
+
+# Generated image (there are no parameters, so there is only one key)
+cache= rendercache.Cache(div_cache_ttl)
+
+# The log of the request or render in progress, one per thread: renders also run in the background threads of rendercache and scheduler
+local= threading.local()
+
 # Adds the path of this script to fonts\`filename` to make it an absolute path    
 def getFontPath(filename):
   folder = os.path.dirname(os.path.realpath(__file__))
@@ -83,9 +98,7 @@ def dict2dict(indeps):
 
 def dict2img(deps) :
     # Loop over all departures to determine column width
-    img = Image.new('RGBA', (10,10), div_bgcol ) # temp
-    draw = ImageDraw.Draw(img) # temp
-    font_txt = ImageFont.truetype(getFontPath(div_txt_fontname), div_txt_fontsize) # temp
+    font_txt = fontcache.truetype(getFontPath(div_txt_fontname), div_txt_fontsize)
     dest_width_max=0
     time_width_max=0
     trackcat_width_max=0
@@ -93,19 +106,19 @@ def dict2img(deps) :
     for ix,dep in enumerate(deps):
         # width of "dest"
         lbl= dep["dest"]
-        sizex,sizey= draw.textsize( lbl, font=font_txt)
+        sizex,sizey= fontcache.textsize( lbl, font_txt)
         dest_width_max= max(dest_width_max,sizex)
         # width of "time"
         lbl= dep["time"]
-        sizex,sizey= draw.textsize( lbl, font=font_txt)
+        sizex,sizey= fontcache.textsize( lbl, font_txt)
         time_width_max= max(time_width_max,sizex)
         # width of "track" and "cat"
         lbl= "track "+dep["track"]+" "+dep["cat"]
-        sizex,sizey= draw.textsize( lbl, font=font_txt)
+        sizex,sizey= fontcache.textsize( lbl, font_txt)
         trackcat_width_max= max(trackcat_width_max,sizex)
         # width of "stats
         lbl= "via "+dep["stats"]
-        sizex,sizey= draw.textsize( lbl, font=font_txt)
+        sizex,sizey= fontcache.textsize( lbl, font_txt)
         stats_width_max= max(stats_width_max,sizex)
     # determine image width
     dX= div_mX+dest_width_max+div_mX + div_mX+time_width_max+div_mX + div_mX+trackcat_width_max+div_mX + div_mX+stats_width_max+div_mX
@@ -114,7 +127,7 @@ def dict2img(deps) :
     # Prepare drawing sheet
     img = Image.new('RGBA', (width,height), div_bgcol )
     draw = ImageDraw.Draw(img)
-    font_txt = ImageFont.truetype(getFontPath(div_txt_fontname), div_txt_fontsize)
+    font_txt = fontcache.truetype(getFontPath(div_txt_fontname), div_txt_fontsize)
     # Loop over all departures
     for ix,dep in enumerate(deps):
         # draw box for departure ix/dep
@@ -142,38 +155,52 @@ def dict2img(deps) :
     return img
 
    
-def application(environ, start_response):
-  log= 'SYNTAX : ns.png\r\n\r\n'
-  try:
+# Loads the departures from NS and converts them to png bytes
+def departures2png():
+    local.log= 'SYNTAX : ns.png\r\n\r\n'
     # Contact info
     url='https://gateway.apiportal.ns.nl/reisinformatie-api/api/v2/departures?station=EHV&maxJourneys=8'
     headers= { 'Ocp-Apim-Subscription-Key': 'a27b9a201fcd4ea2bdfd2971245cc92b'} # Maarten's private key
     # Load remote rss feed
-    resp= requests.get(url, headers=headers)
+    resp= fetch.load(url, headers=headers)
     data= resp.text
-    log+=  f'data   : {data [0:200]}...\r\n'
+    local.log+=  f'data   : {data [0:200]}...\r\n'
     # Parse NS data
     dict= json.loads(data)
     departures= dict["payload"]["departures"]
-    log+=  f'dict   : "{departures[0]["direction"]}" ...\r\n'
+    local.log+=  f'dict   : "{departures[0]["direction"]}" ...\r\n'
     # Extract/normalize departures
     departures2= dict2dict(departures)
     for i,d in enumerate(departures2):
-      log+=  f'dep[{i}] : {d["dest"]} {d["time"]} track {d["track"]} {d["cat"]} via {d["stats"]}\r\n'
+      local.log+=  f'dep[{i}] : {d["dest"]} {d["time"]} track {d["track"]} {d["cat"]} via {d["stats"]}\r\n'
     # Convert to image with table
     image= dict2img(departures2)
-    log+= 'image  : created\r\n'
-    # Send image to web client
-    with io.BytesIO() as memfile:
-      image.save(memfile, format="png")
-      bytes= memfile.getvalue()
-    log+= 'bytes  : created\r\n'
+    local.log+= 'image  : created\r\n'
+    # Convert image to bytes
+    bytes= encoder.png(image, palette=div_png_palette, compress_level=div_png_level, optimize=div_png_optimize)
+    local.log+= f'bytes  : created {len(bytes)}\r\n'
+    return bytes
+
+
+def application(environ, start_response):
+  local.log= 'SYNTAX : ns.png\r\n\r\n'
+  try:
+    # Load departures and convert to image (unless a recent one is cached)
+    bytes= cache.get('', departures2png)
     #raise Exception('Aborted for testing') # Uncomment for testing
     start_response('200 OK',[('Content-type','image/png')])
     return [bytes]
   except Exception as x:
-    log+='\r\nERROR  : %s\r\n' % str(x)
+    local.log+='\r\nERROR  : %s\r\n' % str(x)
     start_response('404 ERROR',[('Content-type','text/plain')])
-    return [ log.encode('utf-8') ]
+    return [ local.log.encode('utf-8') ]
+
+
+# Keep the image warm in the background
+application= scheduler.register(singleflight.wrap(application), minimum=30, maximum=300)
+# Serve the image as WebP to players that accept that (made once per image)
+application= encoder.negotiate(application, lossless=div_webp_lossless, quality=div_webp_quality)
+# Answer players that have the image already (ETag or time) with 304 Not Modified
+application= conditional.wrap(application)
 
 
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+# ntlmpool.py - Shared pool of authenticated keep-alive NTLM connections to the sharepoint server
+#   NTLM authenticates a connection (not a request), with a challenge/response handshake of several round trips.
+#   Each session in this pool owns exactly one keep-alive connection to cfg.hostip, with NTLM credentials.
+#   The handshake is done on the first request of a session; after that the connection stays authenticated,
+#   so later requests over it take a single round trip. Sessions are handed out last-in-first-out,
+#   so that the most recently used (and thus most likely still open) connection is used first.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/ntlmpool.py) and import it with
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import ntlmpool
+#   response= ntlmpool.get( url.replace(cfg.hostname,cfg.hostip) )
+#   response,body= ntlmpool.stream( url.replace(cfg.hostname,cfg.hostip) ) # body yields chunks, close() it when done
+
+
+import queue
+import threading
+import contextlib
+import requests
+import requests.adapters
+import requests_ntlm
+
+
+# Import cfg.username, cfg.password, cfg.hostname, cfg.hostip
+import sys; sys.path.append( "/var/www" ); import cfg
+
+
+# Diversity settings
+div_poolsize = 4                                # maximum number of authenticated connections
+div_timeout = 30                                # timeout (seconds) for a request, and for waiting on a free connection
+div_chunksize = 64*1024                         # size of the chunks of a streamed body
+
+
+pool = queue.LifoQueue()
+pool_lock = threading.Lock()
+pool_created = 0
+
+
+# Creates a session with one keep-alive connection, NTLM credentials and the Host header override
+def create() :
+  session = requests.Session()
+  session.auth = requests_ntlm.HttpNtlmAuth(cfg.username,cfg.password)
+  session.headers['Host'] = cfg.hostname # Hack because DNS is not working
+  adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  return session
+
+
+# Takes a session from the pool; creates one if the pool is not full yet, otherwise waits for one
+def acquire() :
+  global pool_created
+  try :
+    return pool.get_nowait()
+  except queue.Empty :
+    pass
+  with pool_lock :
+    if pool_created < div_poolsize :
+      pool_created += 1
+      return create()
+  return pool.get(timeout=div_timeout)
+
+
+# Returns a session to the pool
+def release(session) :
+  pool.put(session)
+
+
+# Context manager that lends a session from the pool
+@contextlib.contextmanager
+def session() :
+  s = acquire()
+  try :
+    yield s
+  finally :
+    release(s)
+
+
+# Returns the response for `url` (which should already have cfg.hostname replaced by cfg.hostip)
+# over an authenticated connection from the pool. Arguments (e.g. `headers`) are passed to requests.
+def get(url,**kwargs) :
+  kwargs.setdefault("timeout",div_timeout)
+  with session() as s :
+    response = s.get(url,**kwargs)
+    response.content # read the whole body, so that the connection is free for the next request
+  return response
+
+
+# The body of a streamed response, as an iterable of chunks (e.g. to return to a WSGI server).
+# Holds the connection until close() is called (WSGI servers do that when they are done with the body).
+class Body :
+  def __init__(self,session,response,chunksize) :
+    self.session = session
+    self.response = response
+    self.chunksize = chunksize
+
+  def __iter__(self) :
+    return self.response.iter_content(self.chunksize)
+
+  def close(self) :
+    if self.session is None : return
+    self.response.close() # when the body was not read completely, this drops the connection
+    release(self.session)
+    self.session = None
+
+
+# Returns the response for `url` (see get) without reading the body, and the Body to stream it.
+def stream(url,chunksize=div_chunksize,**kwargs) :
+  kwargs.setdefault("timeout",div_timeout)
+  s = acquire()
+  try :
+    response = s.get(url,stream=True,**kwargs)
+  except :
+    release(s)
+    raise
+  return response, Body(s,response,chunksize)
@@ -38,11 +38,13 @@ import datetime
 import platform
 import math
 from PIL import Image
-from PIL import ImageFont
 from PIL import ImageDraw 
-import io
+import sys
 import xlrd
 
+# Import rendercache (shared output cache), singleflight (coalesced requests), fontcache (loaded fonts), encoder (palette png, WebP) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import rendercache, singleflight, fontcache, encoder, conditional
+
 div_color_amsgrey1=( 70, 85, 95)     # color code for ams dark grey
 div_color_amsgrey2=(125,136,143)     # color code for ams medium grey 
 div_color_amsgrey3=(172,178,183)     # color code for ams light grey
@@ -74,6 +76,16 @@ div_innerradius=250                  # Radius of the white inner circle
 div_ray0radius= 410                  # Radius of start of ray
 div_ray1radius= 450                  # Radius of end of ray
 
+div_cache_ttl= 300                   # Seconds a generated image is served from cache (and then again while refreshing)
+div_png_palette= True                # Encode the image with a palette (one byte per pixel) when its colors allow it
+div_png_level= 9                     # Zlib compression level of the png (1 is fastest, 9 is smallest)
+div_png_optimize= False              # Extra (slow) effort to find the smallest png
+div_webp_lossless= True              # WebP (for players that accept it) is lossless, or lossy at div_webp_quality
+div_webp_quality= 80                 # WebP quality (lossy) or effort (lossless), 0-100
+
+# Generated images, keyed by normalized query string
+cache= rendercache.Cache(div_cache_ttl)
+
 # Returns the the unix time stamp for file `path_to_file`
 def creation_date(path_to_file):
   """
@@ -156,9 +168,9 @@ def table2Img(list4, publishdate, dbg):
   # Create drawing objects
   newImage = Image.new('RGBA', (div_width,div_height), div_bgcol )
   draw = ImageDraw.Draw(newImage)
-  font_label = ImageFont.truetype(getFontPath(div_label_fontname), div_label_fontsize)
-  font_head = ImageFont.truetype(getFontPath(div_head_fontname), div_head_fontsize)
-  font_dbg = ImageFont.truetype(getFontPath(div_dbg_fontname), div_dbg_fontsize)
+  font_label = fontcache.truetype(getFontPath(div_label_fontname), div_label_fontsize)
+  font_head = fontcache.truetype(getFontPath(div_head_fontname), div_head_fontsize)
+  font_dbg = fontcache.truetype(getFontPath(div_dbg_fontname), div_dbg_fontsize)
   # Draw the piechart
   index= 0
   angle= 0.0
@@ -186,7 +198,7 @@ def table2Img(list4, publishdate, dbg):
       draw.line( [ x0,y0,x1,y1 ], col, 3 )
       # Compose string for the text label, and determine label size
       lbl= " "+firstname+" "+lastname+" ("+str(count)+") "
-      sizex,sizey=draw.textsize(lbl, font=font_label)
+      sizex,sizey=fontcache.textsize(lbl, font_label)
       # Determine anchor point (tx,ty) for text label, depending on the angle of the pieslice
       tx,ty= (0,0)
       if a<0+30: tx,ty= x1,y1-sizey//2
@@ -209,26 +221,35 @@ def table2Img(list4, publishdate, dbg):
   # At some text inside piechart
   draw.pieslice( [div_centerx-div_innerradius,div_centery-div_innerradius,div_centerx+div_innerradius,div_centery+div_innerradius], 0, 360, div_bgcol)
   lbl= "ams Circle of Inventors"
-  sizex,sizey=draw.textsize(lbl, font=font_head)
+  sizex,sizey=fontcache.textsize(lbl, font_head)
   draw.text( (div_width//2-sizex//2,div_height/2-div_head_fontsize*2), lbl, div_head_fgcolor, font=font_head)
   lbl= "based on patent families"
-  sizex,sizey=draw.textsize(lbl, font=font_label)
+  sizex,sizey=fontcache.textsize(lbl, font_label)
   draw.text( (div_width//2-sizex//2,div_height/2), lbl, div_head_fgcolor, font=font_label)
   lbl= "as of " + publishdate.strftime('%B %Y')
-  sizex,sizey=draw.textsize(lbl, font=font_label)
+  sizex,sizey=fontcache.textsize(lbl, font_label)
   draw.text( (div_width//2-sizex//2,div_height/2+div_label_fontsize*2), lbl, div_head_fgcolor, font=font_label)
   # Draw dbg
   now= datetime.datetime.now()
   draw.text( (8,div_height-div_dbg_fontsize-8),dbg+" "+now.strftime('%Y-%m-%d %H:%M'),div_dbg_fgcolor,font=font_dbg)
   return newImage
 
-# Main function: opens xls file `xlsname` and converts that to a piechart image, which is returned
+# Main function: opens xls file `xlsname` and converts that to a piechart image, which is returned, with its ETag
+# The ETag is made from the ranking and the publish date, so it leaves out the time stamp in the footer and the shuffled
+# order of the slices (they change on every render)
 def xls2img(xlsname):
   publishdate= datetime.datetime.utcfromtimestamp((creation_date(getScriptPath(xlsname)))) 
   list3,log= readXLSX(xlsname)
   list4= add_rank(list3)
   image= table2Img(list4,publishdate,log)
-  return image
+  etag= conditional.etag( (xlsname,sorted(list4),publishdate.isoformat(),log) )
+  return image,etag
+
+# Opens xls file `xlsname` and converts that to a piechart image, which is returned as png bytes, and their ETag
+def xls2png(xlsname):
+  image,etag= xls2img(xlsname)
+  bytes= encoder.png(image, palette=div_png_palette, compress_level=div_png_level, optimize=div_png_optimize)
+  return bytes,etag
 
 # Entry point for webserver
 def application(environ, start_response):
@@ -240,17 +261,12 @@ def application(environ, start_response):
     pos= xlsname.find("&")
     if pos>=0: xlsname= xlsname[:pos]
     log+= 'xlsname: "%s"\r\n' % xlsname
-    # Load xls and convert to image
+    # Load xls and convert to image (unless a recent one is cached)
     if xlsname=='': raise Exception('&<url-to-xls> argument missing')
-    image= xls2img(xlsname)
-    log+= 'image  : created\r\n'
-    # Send image to web client
-    with io.BytesIO() as memfile:
-      image.save(memfile, format="png")
-      bytes= memfile.getvalue()
+    bytes,etag= cache.get( rendercache.normalize({'xls':xlsname}), lambda: xls2png(xlsname) )
     log+= 'bytes  : created\r\n'
     status= '200 OK'
-    response_header= [('Content-type','image/png')]
+    response_header= [('Content-type','image/png'),('ETag',etag)]
     if False: raise Exception('Aborted for testing') # Change False to True for testing
     start_response(status,response_header)
     return [bytes]
@@ -259,10 +275,18 @@ def application(environ, start_response):
     start_response('404 ERROR',[('Content-type','text/plain')])
     return [ log.encode('utf-8') ]
 
+
+# Players requesting the same image at the same moment share one render
+application= singleflight.wrap(application)
+# Serve the image as WebP to players that accept that (made once per image)
+application= encoder.negotiate(application, lossless=div_webp_lossless, quality=div_webp_quality)
+# Answer players that have the image already (ETag or time) with 304 Not Modified
+application= conditional.wrap(application)
+
 # Entry point for testing
 if __name__ == "__main__":
   print("Local test mode")
-  image= xls2img(r"ams_rank.xlsx")
+  image,etag= xls2img(r"ams_rank.xlsx")
   image.save("ams_rank.png","PNG")
   print("done")
 
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+# pilchart.py - Small line chart renderer on top of Pillow, a light alternative for matplotlib
+#   Draws a grid of panels; each panel has one line (with dot markers), a frame with ticks and tick labels,
+#   axis labels and a title. The data is mapped to pixels with numpy in one go, and drawn as one polyline.
+#   It only knows what the plot scripts need: time (numpy datetime64) on the x-axis and numbers on the y-axis.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/pilchart.py), with the fonts in the fonts subdirectory, and import it with
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import pilchart
+#   image= pilchart.grid( [{"title":"ENS210","xlabel":"Date","ylabel":"T","x":times,"y":values,"color":"#ffd43b"}], rows=1, cols=1 )
+
+
+import os
+import sys
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageColor
+
+# Import fontcache (loaded fonts), it lives next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fontcache
+
+
+# Diversity settings
+div_width = 1536                                # default width of the image (as the matplotlib figure of thingspeak.png.py)
+div_height = 800                                # default height of the image
+div_fontname = "ARIAL.TTF"                      # font for all texts (in the fonts subdirectory)
+div_fontsize = 12                               # size of the tick and axis labels
+div_titlesize = 15                              # size of the titles
+div_ticks = 6                                   # at most this number of ticks per axis
+div_margin = 0.05                               # fraction of the data range left free above and below the line
+div_timesteps = [60, 120, 300, 600, 900, 1800, 3600, 2*3600, 3*3600, 6*3600, 12*3600, 86400, 2*86400, 7*86400] # seconds between time ticks
+
+
+# Returns the font of `size` (the Pillow default font when the font file is missing)
+def font(size):
+  try:
+    return fontcache.truetype(os.path.join(os.path.dirname(os.path.realpath(__file__)), "fonts", div_fontname), size)
+  except OSError:
+    return ImageFont.load_default()
+
+
+# Returns (ticks,labels) for a number axis from `lo` to `hi`: at most `n` ticks at steps of 1, 2, 2.5 or 5 times a power of 10
+def numticks(lo, hi, n=div_ticks):
+  raw = (hi-lo)/n
+  power = 10.0**np.floor(np.log10(raw))
+  step = min(m*power for m in (1,2,2.5,5,10) if m*power>=raw)
+  ticks = np.arange(np.ceil(lo/step)*step, hi, step)
+  decimals = max(0, int(-np.floor(np.log10(step)+1e-9)) + (1 if round(step/power,1)==2.5 else 0))
+  return ticks, ["%.*f" % (decimals,t) for t in ticks]
+
+
+# Returns (ticks,labels) for a time axis from `lo` to `hi` (seconds): at most `n` ticks at a step from div_timesteps
+def timeticks(lo, hi, n=div_ticks):
+  step = next( (s for s in div_timesteps if (hi-lo)/s <= n), div_timesteps[-1] )
+  ticks = np.arange(-(-lo//step)*step, hi+1, step)
+  strings = np.datetime_as_string(ticks.astype("datetime64[s]"), unit="m") # e.g. 2019-02-27T08:00
+  if step >= 86400: labels = [s[5:10] for s in strings]
+  elif hi-lo > 86400: labels = [s[8:10]+" "+s[11:16] for s in strings]
+  else: labels = [s[11:16] for s in strings]
+  return ticks, labels
+
+
+# Draws `text` rotated a quarter turn counter clockwise (for a y-axis label), centered on (`x`,`y`)
+def vtext(image, x, y, text, font, fill):
+  w, h = fontcache.textsize(text, font)
+  mask = Image.new("L", (w,h+2), 0)
+  ImageDraw.Draw(mask).text((0,0), text, font=font, fill=255)
+  mask = mask.rotate(90, expand=True)
+  image.paste(ImageColor.getrgb(fill), (int(x-mask.width/2), int(y-mask.height/2)), mask)
+
+
+# Draws `panel` (a dict, see grid) in `box` (x0,y0,x1,y1) of `image`
+def draw_panel(image, draw, box, panel):
+  x0, y0, x1, y1 = box
+  small, big = font(div_fontsize), font(div_titlesize)
+  w, h = fontcache.textsize(panel["title"], big)
+  draw.text(((x0+x1-w)//2, y0+4), panel["title"], font=big, fill="black")
+  if "x" not in panel or len(panel["x"])==0: return
+  # The plot area
+  left, top, right, bottom = x0+72, y0+28, x1-14, y1-40
+  draw.rectangle([left,top,right,bottom], outline="black")
+  # Data ranges
+  t = panel["x"].astype("datetime64[s]").astype(np.int64)
+  v = np.asarray(panel["y"], dtype=np.float64)
+  tlo, thi = int(t.min()), int(t.max())
+  if thi==tlo: thi = tlo+60
+  vlo, vhi = float(v.min()), float(v.max())
+  pad = (vhi-vlo)*div_margin or abs(vlo)*div_margin or 1.0
+  vlo, vhi = vlo-pad, vhi+pad
+  # Ticks and labels
+  for tick,label in zip(*numticks(vlo,vhi)):
+    y = bottom - (tick-vlo)*(bottom-top)/(vhi-vlo)
+    draw.line([(left-4,y),(left,y)], fill="black")
+    w, h = fontcache.textsize(label, small)
+    draw.text((left-7-w, y-h/2), label, font=small, fill="black")
+  for tick,label in zip(*timeticks(tlo,thi)):
+    x = left + (tick-tlo)*(right-left)/(thi-tlo)
+    draw.line([(x,bottom),(x,bottom+4)], fill="black")
+    w, h = fontcache.textsize(label, small)
+    draw.text((x-w/2, bottom+6), label, font=small, fill="black")
+  if panel.get("xlabel"):
+    w, h = fontcache.textsize(panel["xlabel"], small)
+    draw.text(((left+right-w)/2, bottom+22), panel["xlabel"], font=small, fill="black")
+  if panel.get("ylabel"):
+    vtext(image, x0+10, (top+bottom)/2, panel["ylabel"], small, "black")
+  # The data, mapped to pixels in one go
+  px = left + (t-tlo)*((right-left)/(thi-tlo))
+  py = bottom - (v-vlo)*((bottom-top)/(vhi-vlo))
+  color = panel.get("color","#1f77b4")
+  draw.line(list(zip(px.tolist(),py.tolist())), fill=color, width=1)
+  dx, dy = np.meshgrid(np.arange(-1,2), np.arange(-1,2)) # a 3x3 dot per point
+  dots = np.stack( [(np.rint(px)[:,None]+dx.ravel()).ravel(), (np.rint(py)[:,None]+dy.ravel()).ravel()], axis=1 )
+  draw.point(list(map(tuple,dots.tolist())), fill=color)
+
+
+# Returns an image with `panels` in a grid of `rows` by `cols`.
+# Each panel is a dict with "title", and optionally "x" (numpy datetime64), "y" (numbers), "xlabel", "ylabel" and "color";
+# a panel without "x" only shows its title (e.g. for a channel without data).
+def grid(panels, rows, cols, width=div_width, height=div_height):
+  image = Image.new("RGB", (width,height), "white")
+  draw = ImageDraw.Draw(image)
+  for i,panel in enumerate(panels[:rows*cols]):
+    r, c = divmod(i, cols)
+    box = (c*width//cols, r*height//rows, (c+1)*width//cols, (r+1)*height//rows)
+    draw_panel(image, draw, box, panel)
+  return image
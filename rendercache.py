@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+# rendercache.py - Shared in-process cache for the rendered output (e.g. png bytes) of the image scripts
+#   Each script creates its own Cache with its own time-to-live, and looks up the rendered output by a key:
+#   the normalized query string (parameters sorted, defaults applied), so that equivalent urls share one entry.
+#   Within the time-to-live the cached output is returned. After that, for another `maxstale` seconds,
+#   the stale output is still returned while a background thread renders a fresh one.
+#   Only when there is no usable entry, the caller waits for the render.
+#   While the scheduler refreshes (see scheduler.py), the output is always rendered (and cached) again.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/rendercache.py) and import it with
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import rendercache
+#   cache= rendercache.Cache(ttl=60)
+#   bytes= cache.get( rendercache.normalize({'stops':stops,'maxrow':maxrow}), lambda: render(stops,maxrow) )
+
+
+import time
+import threading
+import collections
+import urllib.parse
+import scheduler
+
+
+# Returns the normalized query string for dictionary `params` (which should have the defaults applied).
+# Parameters are sorted by name, those with value None are left out.
+def normalize(params) :
+  return urllib.parse.urlencode( sorted( (k,str(v)) for k,v in params.items() if v is not None ) )
+
+
+# A rendered output, with the moment it becomes stale
+class Entry :
+  def __init__(self,value,ttl) :
+    self.value = value
+    self.expires = time.time() + ttl
+    self.refreshing = False
+
+
+# A cache of rendered outputs for one script
+class Cache :
+
+  # Outputs are fresh for `ttl` seconds, and served stale (while being refreshed) for `maxstale` more seconds (default `ttl`).
+  # At most `maxkeys` outputs are kept (least recently used are dropped).
+  def __init__(self,ttl,maxstale=None,maxkeys=32) :
+    self.ttl = ttl
+    self.maxstale = ttl if maxstale is None else maxstale
+    self.maxkeys = maxkeys
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  # Returns the output for `key`, calling `render()` to create it when there is no usable cached output (or when the scheduler is refreshing).
+  # Exceptions raised by `render()` are passed to the caller (when it waits for it) or ignored (background refresh).
+  def get(self,key,render) :
+    if scheduler.refreshing() :
+      value = render()
+      self.put(key,value)
+      return value
+    now = time.time()
+    with self.lock :
+      entry = self.entries.get(key)
+      if entry is not None :
+        self.entries.move_to_end(key)
+        if now < entry.expires :
+          return entry.value
+        if now < entry.expires + self.maxstale :
+          if not entry.refreshing :
+            entry.refreshing = True
+            threading.Thread(target=self.refresh, args=(key,render,entry), daemon=True).start()
+          return entry.value
+    value = render()
+    self.put(key,value)
+    return value
+
+  # Renders the output for `key` again (in the background), the stale `entry` stays in use when that fails
+  def refresh(self,key,render,entry) :
+    try :
+      value = render()
+    except Exception :
+      with self.lock : entry.refreshing = False
+      return
+    self.put(key,value)
+
+  # Stores `value` as fresh output for `key`
+  def put(self,key,value) :
+    with self.lock :
+      self.entries[key] = Entry(value,self.ttl)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxkeys : self.entries.popitem(last=False)
+
+  # Drops all cached outputs
+  def clear(self) :
+    with self.lock :
+      self.entries.clear()
@@ -33,10 +33,27 @@ version = "v1.1"
 
 import os
 import io
+import sys
+import time
+import array
 import urllib
 import random
+import threading
+import collections
 import requests
 
+# Import encoder (WebP) and conditional (ETag, 304), they live next to this script (webserver) or one directory up (repository)
+folder = os.path.dirname(os.path.realpath(__file__))
+sys.path.extend( [folder, os.path.dirname(folder)] ); import encoder, conditional
+
+
+# Diversity settings
+div_webp_lossless = True                        # WebP (for players that accept it) of a png is lossless (of a jpeg always lossy)
+div_webp_quality = 80                           # WebP quality (lossy) or effort (lossless), 0-100
+div_recheck = 2                                 # seconds between checks whether a directory (tree) changed (one stat per directory)
+div_maxindexes = 16                             # maximum number of directory indexes kept (least recently used are dropped)
+div_maxothers = 100                             # maximum number of names of other (non image) files kept per index, for the log
+
 
 # Supported image types with the associated mimetype
 mimetypes = {
@@ -68,37 +85,127 @@ def abspath(dir):
   return path
 
 
-# Pick a random image from directory `imgsdir`
+# The image files in one directory (and its subdirectories when `recursive`), scanned once and kept until a directory changes.
+# The names (paths relative to the directory) are kept compact: one bytes object with the names (each ended by a 0 byte)
+# and an array with the offset of each name, so that a random pick is an index lookup, also for tens of thousands of images.
+# A scan replaces the tuple `files` (names,offsets) in one assignment: a request takes it once and uses only that tuple,
+# so that a scan in another thread can not mix the offsets of one scan with the names (or the length) of another.
+class Index :
+  def __init__(self,path,recursive) :
+    self.path = path
+    self.recursive = recursive
+    self.lock = threading.Lock()
+    self.files = (b"", array.array("Q")) # (names,offsets)
+    self.others = (0, []) # the number of other files, and the first `div_maxothers` names
+    self.mtimes = None # modification time (ns) of every scanned directory; adding, removing or renaming a file changes it
+    self.checked = 0
+
+  # Scans the directory (tree) for image files
+  def scan(self) :
+    names = bytearray()
+    offsets = array.array("Q")
+    others = []
+    numothers = 0
+    mtimes = {}
+    dirs = [""]
+    while dirs :
+      dir = dirs.pop()
+      fulldir = os.path.join(self.path,dir)
+      mtimes[fulldir] = os.stat(fulldir).st_mtime_ns
+      with os.scandir(fulldir) as entries :
+        for entry in entries :
+          name = os.path.join(dir,entry.name)
+          if self.recursive and entry.is_dir(follow_symlinks=False) :
+            dirs.append(name)
+          elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in mimetypes :
+            offsets.append(len(names))
+            names += os.fsencode(name) + b"\0"
+          else :
+            numothers += 1
+            if len(others) < div_maxothers : others.append(name)
+    self.files = (bytes(names), offsets)
+    self.others = (numothers, others)
+    self.mtimes = mtimes
+
+  # Returns True when a scanned directory changed (or disappeared) since the scan
+  def changed(self) :
+    try :
+      return any( os.stat(dir).st_mtime_ns!=mtime for dir,mtime in self.mtimes.items() )
+    except OSError :
+      return True
+
+  # Scans again when the directory (tree) changed; checks at most once per `div_recheck` seconds
+  def update(self) :
+    with self.lock :
+      now = time.time()
+      if self.mtimes is not None and now-self.checked < div_recheck : return
+      if self.mtimes is None or self.changed() : self.scan()
+      self.checked = now
+
+  # Scans again now (e.g. a picked file was removed within `div_recheck` seconds after the last check)
+  def rescan(self) :
+    with self.lock :
+      self.scan()
+      self.checked = time.time()
+
+
+# Returns the name (path relative to the directory) of image file `i` in `files` (the (names,offsets) of an Index)
+def filename(files,i) :
+  names,offsets = files
+  start = offsets[i]
+  return os.fsdecode( names[start:names.index(b"\0",start)] )
+
+
+# The indexes, keyed by (path,recursive); ordered for least-recently-used eviction
+indexes = collections.OrderedDict()
+indexes_lock = threading.Lock()
+
+
+# Returns the up to date index of directory `path`
+def getindex(path,recursive) :
+  key = (path,recursive)
+  with indexes_lock :
+    index = indexes.get(key)
+    if index is None :
+      index = Index(path,recursive)
+      indexes[key] = index
+    indexes.move_to_end(key)
+    while len(indexes) > div_maxindexes : indexes.popitem(last=False)
+  index.update()
+  return index
+
+
+# Pick a random image from directory `imgsdir` (or its whole tree when `recursive`)
 # Returns the final image buffer and the extension.
-def main(imgsdir) :
+def main(imgsdir,recursive=False) :
   global log
   log = ""
   log += f"Random image picker - {version}\r\n"
-  log += "SYNTAX : rndimg.png?imgdir=.\r\n"
+  log += "SYNTAX : rndimg.png?imgsdir=.[&recursive=1]\r\n"
   # Get absolute path to dir with images
   path = abspath(imgsdir)
-  # Get a list of images (and others for error reporting)
-  images = []
-  other = []
-  for filename in os.listdir(path) :
-    fullname = os.path.join(path,filename)
-    extension = os.path.splitext(fullname)[1].lower()
-    if os.path.isfile(fullname) and extension in mimetypes : 
-      images.append(filename)
-    else :
-      other.append(filename)
-  log+= f"images : {images}\r\n"
-  log+= f"other  : {other}\r\n"
-  if len(images) == 0 :
-    return empty_png, '.png'
-  # Open a random image
-  index = random.randrange(len(images))
-  fullname = os.path.join(path,images[index])
-  extension = os.path.splitext(fullname)[1]
-  log+= f"random : {fullname}\r\n"
-  with open(fullname, "rb") as file :
-    image = file.read()
-  return image, extension
+  # Get the index of the images (and the others for error reporting), it is only scanned again when a directory changed
+  index = getindex(path,recursive)
+  numothers,others = index.others
+  log+= f"images : {len(index.files[1])}\r\n"
+  log+= f"other  : {numothers} {others}\r\n"
+  # Open a random image; a name may be stale (removed since the last check), then scan again and pick once more
+  for attempt in range(2) :
+    files = index.files # one snapshot for the count and the name
+    count = len(files[1])
+    if count == 0 :
+      return empty_png, '.png'
+    fullname = os.path.join(path,filename(files,random.randrange(count)))
+    extension = os.path.splitext(fullname)[1].lower() # a key of mimetypes, also for IMG_0001.JPG
+    log+= f"random : {fullname}\r\n"
+    try :
+      with open(fullname, "rb") as file :
+        image = file.read()
+      return image, extension
+    except OSError :
+      if attempt == 1 : raise
+      log+= "stale  : scan again\r\n"
+      index.rescan()
 
 
 # The entry point for the webserver
@@ -108,8 +215,9 @@ def application(environ, start_response):
     # Get parameters from URL
     params = urllib.parse.parse_qs(environ['QUERY_STRING'])
     imgsdir = params.get('imgsdir', ["."])[0]  # default current dir
+    recursive = params.get('recursive', ["0"])[0] not in ("0","") # default: only the directory itself, not its subdirectories
     # Get random image from imgsdir
-    image,extension = main(imgsdir)
+    image,extension = main(imgsdir,recursive)
     # raise Exception("Aborted for testing") # Uncomment for testing
     start_response("200 OK",[("Content-type",mimetypes[extension])])
     return [image]
@@ -119,6 +227,12 @@ def application(environ, start_response):
     return [ log.encode("utf-8") ]
 
 
+# Serve the images as WebP to players that accept that (made once per image)
+application = encoder.negotiate(application, lossless=div_webp_lossless, quality=div_webp_quality)
+# Answer players that have the image already (ETag or time) with 304 Not Modified
+application = conditional.wrap(application)
+
+
 # The entry point for command line test
 if __name__ == "__main__":
   global log
@@ -27,11 +27,14 @@ version = "v1"
 
 
 import sys
+import os
 import ntpath
-import requests
 import xml.dom.minidom
 from xml.sax.saxutils import escape
 
+# Import fetch (shared upstream cache), scheduler (background refresh), singleflight (coalesced requests) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fetch, scheduler, singleflight, conditional
+
 
 # Get the text string from a DOM element (safely)
 def xml_text(node):
@@ -98,6 +101,14 @@ def parse(rssin):
     return (meta,triples)
 
 
+# Decodes and parses the rss feed in response `resp`.
+# Called via fetch.memo, so only done again when the remote feed actually changed.
+def load(resp):
+    resp.encoding = resp.apparent_encoding
+    rssin= resp.text
+    return (rssin,parse(rssin))
+
+
 def unparse(meta,triples):
   s1= '<?xml version="1.0" encoding="utf-8"?>\r\n'\
       '<rss>\r\n'\
@@ -131,12 +142,10 @@ def application(environ, start_response):
     url= url[:pos] 
     log+= 'url    : "%s"\r\n' % url
     # Load remote rss feed
-    resp= requests.get(url)
-    resp.encoding = resp.apparent_encoding
-    rssin= resp.text
+    resp= fetch.get(url)
+    # Parse rss feed (only when it changed)
+    (rssin,(meta,triples))= fetch.memo(resp,load)
     log+= 'rssin  : "%s" ...\r\n' % rssin[0:1000]
-    # Parse rss feed
-    (meta,triples)= parse(rssin)
     log+= 'meta   : "%s"\r\n' % meta[0] 
     log+= 'triple0: "%s", "%s", "%s"\r\n' % triples[0] 
     # Create rss to output
@@ -152,3 +161,9 @@ def application(environ, start_response):
     return [ log.encode('utf-8') ]
 
 
+# Keep the channels (one per feed url) warm in the background; the query string is the feed url itself, it is not normalized
+application= scheduler.register(singleflight.wrap(application), minimum=120, maximum=3600, normalized=False)
+# Answer players that have the channel already (ETag or time) with 304 Not Modified
+application= conditional.wrap(application)
+
+
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+# scheduler.py - Shared background refresher that keeps the output of the scripts warm
+#   A script registers its `application` function. For every query string that players request, the scheduler
+#   keeps the last good response, and serves that to players. In the background it calls the application again,
+#   ahead of demand. The refresh interval adapts to how often the output actually changes: it is halved (down to
+#   `minimum`) when the output changed, and doubled (up to `maximum`) when it did not. Query strings that are not
+#   requested for `idle` seconds are dropped. Query strings are normalized (parameters sorted by name), so that equivalent
+#   query strings share one job. Only good responses are kept: a "200 OK" that a script marked with the `fallback`
+#   header (e.g. a channel with an "error" item after a failed download) is passed to the player that asked for it,
+#   but a refresh that gets one keeps the previous good response, as for any other failure. A kept response is served
+#   for at most `maxage` seconds (by default `div_maxage` times `maximum`) after it was made: when the refreshes keep
+#   failing (e.g. the origin is down), players get what the application makes of it (e.g. its error page) instead of
+#   outdated output (e.g. departures that have left).
+#   While the scheduler refreshes, refreshing() is True, so that the caches (fetch.py, rendercache.py) go to the
+#   origin instead of returning their cached result.
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/scheduler.py) and register at the end of a script
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import scheduler
+#   application = scheduler.register(application, minimum=15, maximum=300)
+# and mark a response that is a fallback for a failure with
+#   start_response( '200 OK', [('Content-type','text/xml'), scheduler.fallback] )
+
+
+import time
+import hashlib
+import threading
+import urllib.parse
+import concurrent.futures
+
+
+# Diversity settings
+div_workers = 4                                 # number of threads refreshing in parallel
+div_idle = 24*3600                              # default seconds a query string is kept warm after its last request
+div_maxkeys = 16                                # maximum number of query strings kept warm per application
+div_maxage = 4                                  # default maximum age of a kept response, in multiples of the `maximum` refresh interval
+
+
+# Header of a "200 OK" response that is a fallback for a failure (it is not kept, and removed before the response is served)
+fallback = ("X-Scheduler-Fallback","1")
+
+
+# Set (per thread) while the scheduler calls an application
+local = threading.local()
+
+
+# Returns True when the current thread is refreshing for the scheduler (caches should then not serve cached results)
+def refreshing() :
+  return getattr(local,"refresh",False)
+
+
+# The last good response for one query string of one application, and when to refresh it
+class Job :
+  def __init__(self,endpoint,query,minimum) :
+    self.endpoint = endpoint
+    self.query = query # as first requested, the application is called with it
+    self.response = None # (status,headers,body)
+    self.made = None # when the response was made
+    self.digest = None
+    self.interval = minimum
+    self.due = time.time() + minimum
+    self.used = time.time()
+    self.running = False
+
+
+# Calls WSGI `app` for `query` and returns its response as (status,headers,body)
+def call(app,query) :
+  environ = {"REQUEST_METHOD":"GET", "QUERY_STRING":query}
+  started = []
+  def start_response(status,headers,exc_info=None) :
+    started[:] = [status,headers]
+  result = app(environ,start_response)
+  try :
+    body = b"".join(result)
+  finally :
+    if hasattr(result,"close") : result.close()
+  return started[0], started[1], body
+
+
+# Returns query string `query` with its parameters sorted by name (like rendercache.normalize), the key of its job.
+# The sort is stable: repeated parameters (e.g. url=...&url=... of multi.png) keep their order.
+def normalize(query) :
+  return urllib.parse.urlencode( sorted( urllib.parse.parse_qsl(query, keep_blank_values=True), key=lambda p: p[0] ) )
+
+
+# Returns True when a response is good to keep: "200 OK" and not marked as `fallback`
+def good(status,headers) :
+  return status.startswith("200") and fallback not in headers
+
+
+# Returns the digest of a response, to see whether the output changed: its ETag when the application set one
+# (that leaves out volatile decorations like a time stamp, see conditional.py), otherwise the hash of the body
+def digest(headers,body) :
+  for name,value in headers :
+    if name.lower()=="etag" : return value
+  return hashlib.sha1(body).digest()
+
+
+# A registered application, with its jobs (one per query string)
+class Endpoint :
+  def __init__(self,app,minimum,maximum,maxage,idle,normalized) :
+    self.app = app
+    self.minimum = minimum
+    self.maximum = maximum
+    self.maxage = maxage
+    self.idle = idle
+    self.normalized = normalized
+    self.jobs = {} # key (see normalize) -> job
+
+  # The WSGI entry point that replaces the registered application
+  def __call__(self,environ,start_response) :
+    query = environ.get("QUERY_STRING","")
+    key = normalize(query) if self.normalized else query
+    with lock :
+      job = self.jobs.get(key)
+      if job is not None : job.used = time.time()
+      response = job.response if job is not None and time.time() - job.made <= self.maxage else None
+    if response is not None :
+      status,headers,body = response
+      start_response(status,list(headers))
+      return [body]
+    # Not warm (yet), or the refreshes failed for too long: call the application and keep the response warm from now on
+    status,headers,body = call(self.app,query)
+    if good(status,headers) :
+      with lock :
+        job = self.jobs.get(key)
+        if job is None and len(self.jobs) < div_maxkeys :
+          job = Job(self,query,self.minimum)
+          self.jobs[key] = job
+          wakeup.notify()
+        if job is not None :
+          job.response = (status,headers,body)
+          job.made = time.time()
+          job.digest = digest(headers,body)
+    start_response(status,[h for h in headers if h!=fallback])
+    return [body]
+
+
+# Refreshes `job` (in a worker thread) and adapts its interval
+def refresh(job) :
+  local.refresh = True
+  try :
+    status,headers,body = call(job.endpoint.app,job.query)
+  except Exception :
+    status = "500 ERROR"
+  finally :
+    local.refresh = False
+  with lock :
+    if good(status,headers) :
+      current = digest(headers,body)
+      if current==job.digest :
+        job.interval = min(job.interval*2, job.endpoint.maximum)
+      else :
+        job.interval = max(job.interval/2, job.endpoint.minimum)
+      job.response = (status,headers,body)
+      job.made = time.time()
+      job.digest = current
+    else :
+      job.interval = job.endpoint.minimum # keep serving the old (good) response, but retry soon
+    job.due = time.time() + job.interval
+    job.running = False
+    wakeup.notify()
+
+
+# The scheduler thread: submits due jobs to the workers, and drops idle jobs
+def run() :
+  with lock :
+    while True :
+      now = time.time()
+      due = now + 60
+      for endpoint in endpoints :
+        for key,job in list(endpoint.jobs.items()) :
+          if now - job.used > endpoint.idle :
+            del endpoint.jobs[key]
+          elif job.running :
+            pass
+          elif job.due <= now :
+            job.running = True
+            try :
+              workers.submit(refresh,job)
+            except RuntimeError :
+              return # interpreter is shutting down
+          else :
+            due = min(due,job.due)
+      wakeup.wait(max(due-now,0.1))
+
+
+lock = threading.Lock()
+wakeup = threading.Condition(lock)
+endpoints = []
+workers = None
+thread = None
+
+
+# Registers WSGI application `app`, and returns the WSGI application to use instead.
+# Responses are refreshed every `minimum` to `maximum` seconds, depending on how often they change.
+# A response is served for at most `maxage` seconds (default: `div_maxage` times `maximum`) when the refreshes fail.
+# Set `normalized` to False when the order of the parameters matters to the application.
+def register(app,minimum,maximum,maxage=None,idle=div_idle,normalized=True) :
+  global workers, thread
+  endpoint = Endpoint(app,minimum,maximum,maxage if maxage is not None else div_maxage*maximum,idle,normalized)
+  with lock :
+    endpoints.append(endpoint)
+    if thread is None :
+      workers = concurrent.futures.ThreadPoolExecutor(div_workers)
+      thread = threading.Thread(target=run, daemon=True)
+      thread.start()
+  return endpoint
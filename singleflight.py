@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+# singleflight.py - Shared coalescing of concurrent identical requests to a script
+#   When many players request the same url at the same moment (e.g. when their playlists reload), only the first
+#   request calls the application; the others wait for it and get the same response (status, headers and body).
+#   Requests are identical when they have the same query string (the path is fixed per script). Request headers are not
+#   part of that key, so wrap only an application whose response depends on the query string alone: the wrappers that
+#   look at headers (encoder.negotiate for Accept, conditional.wrap for If-None-Match) go outside of it. Otherwise pass
+#   a `key` function that makes such headers part of the key.
+#   Nothing is kept once the response is delivered: the next request calls the application again
+#   (keeping results is the job of rendercache.py and scheduler.py).
+
+# Place this file next to the scripts (e.g. /var/www/html/rss/singleflight.py) and wrap the application at the end of a script
+#   import sys, os; sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import singleflight
+#   application = singleflight.wrap(application)
+# or, for a script that is kept warm by the scheduler
+#   application = scheduler.register(singleflight.wrap(application), minimum=15, maximum=300)
+# and then (in this order, outside) application = encoder.negotiate(application) and application = conditional.wrap(application)
+
+
+import threading
+
+
+# A call of the application in progress; `done` is set when its response (or exception) is available
+class Flight :
+  def __init__(self) :
+    self.done = threading.Event()
+    self.response = None # (status,headers,body)
+    self.error = None
+
+
+# Calls WSGI `app` for `environ` and returns its response as (status,headers,body)
+def call(app,environ) :
+  started = []
+  def start_response(status,headers,exc_info=None) :
+    started[:] = [status,headers]
+  result = app(environ,start_response)
+  try :
+    body = b"".join(result)
+  finally :
+    if hasattr(result,"close") : result.close()
+  return started[0], started[1], body
+
+
+# Returns the key of the request in `environ` for wrap(): its query string
+def query(environ) :
+  return environ.get("QUERY_STRING","")
+
+
+# Returns a WSGI application that passes requests to WSGI application `app`, one call per key at a time.
+# The key of a request is `key(environ)`, by default its query string (see query).
+def wrap(app,key=query) :
+  flights = {}
+  lock = threading.Lock()
+  def application(environ,start_response) :
+    flightkey = key(environ)
+    with lock :
+      flight = flights.get(flightkey)
+      leader = flight is None
+      if leader :
+        flight = Flight()
+        flights[flightkey] = flight
+    if leader :
+      try :
+        flight.response = call(app,environ)
+      except Exception as x :
+        flight.error = x
+      finally :
+        with lock : del flights[flightkey]
+        flight.done.set()
+    else :
+      flight.done.wait()
+    if flight.error is not None : raise flight.error
+    status,headers,body = flight.response
+    start_response(status,list(headers))
+    return [body]
+  return application
@@ -1,36 +1,194 @@
 #!/usr/bin/python3
 # sp.py - Script to bridge to a sharepoint site (which requires login)
 #         e.g. http://192.168.1.1/sp?http://sharepoint.company.com/pictures/banner.jpg
+#         or scaled down for the display http://192.168.1.1/sp?fit=1920x1026&fmt=webp&http://sharepoint.company.com/pictures/banner.jpg
 # 2019 may 06  v2  Maarten Pennings  Moved cfg.py
 # 2019 may 03  v1  Maarten Pennings  Created
 
 
-import requests
-import requests_ntlm
+import os
+import io
+import hashlib
+from PIL import Image, ImageOps
 
 
 # Import cfg.username, cfg.password, cfg.hostname, cfg.hostip
 import sys; sys.path.append( "/var/www" ); import cfg
 
+# Import ntlmpool (authenticated keep-alive connections to sharepoint) and diskcache (on-disk cache), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import ntlmpool, diskcache
+
+
+# The image is streamed from sharepoint to the player (not buffered), with Content-Length, ETag and Last-Modified.
+# The Range and conditional headers of the player are passed to sharepoint, so that an unchanged image costs a "304 Not Modified".
+
+# Request headers passed from the player to sharepoint (WSGI environ key, header name)
+request_headers= [('HTTP_RANGE','Range'), ('HTTP_IF_RANGE','If-Range'), ('HTTP_IF_NONE_MATCH','If-None-Match'), ('HTTP_IF_MODIFIED_SINCE','If-Modified-Since')]
+# Response headers passed from sharepoint to the player
+response_headers= ['Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified']
+
+
+# Diversity settings
+div_formats= {'jpeg':'image/jpeg', 'webp':'image/webp', 'png':'image/png'} # formats for the variants (fmt=), with their mime type
+div_format= 'jpeg'    # default format of a variant
+div_quality= 85       # default quality (q=) of a jpeg or webp variant
+div_maxfit= 4096      # largest width or height of a variant
+
+
+# Images are cached on disk, and served from there; they are revalidated with sharepoint (in the background) after an hour.
+# If the cache directory can not be created, images are proxied without caching.
+try:
+  cache= diskcache.Cache( os.path.join(diskcache.div_dir,'sp') )
+except OSError:
+  cache= None
+
+
+# Returns the meta data for the cache (mime, etag, modified) of sharepoint `response`
+def response2meta(response):
+  return { 'mime':response.headers.get('Content-Type','application/octet-stream'), 'etag':response.headers.get('ETag'), 'modified':response.headers.get('Last-Modified') }
+
+
+# Loads `url` from sharepoint if it changed since it was cached (called by the cache in the background).
+# Returns (content,meta) or None if it did not change.
+def reload(url):
+  entry= cache.lookup(url)
+  headers= {'Accept-Encoding':'identity'}
+  if entry is not None and entry['etag']: headers['If-None-Match']= entry['etag']
+  if entry is not None and entry['modified']: headers['If-Modified-Since']= entry['modified']
+  response= ntlmpool.get(url,headers=headers)
+  if response.status_code==304: return None
+  if response.status_code!=200: raise Exception('Remote site failed with status %d' % response.status_code)
+  return (response.content, response2meta(response))
+
+
+# Returns the chunks of (and then closes) `file`
+def file2chunks(file):
+  with file:
+    while True:
+      chunk= file.read(ntlmpool.div_chunksize)
+      if not chunk: break
+      yield chunk
+
+
+# Returns the content of `entry` as an open file: from the cache on disk, or from memory (see store)
+def entry2file(entry):
+  if 'content' in entry: return io.BytesIO(entry['content'])
+  return open(cache.path(entry['hash']),'rb')
+
+
+# Stores `content` for `key` in the cache with `meta`, and returns its entry.
+# Content that does not fit in the cache is not stored; its entry then holds the content itself, and it is served from memory.
+def store(key, content, meta):
+  entry= cache.put(key, content, meta)
+  if entry is None: entry= dict(meta, hash=hashlib.sha256(content).hexdigest(), size=len(content), content=content)
+  return entry
+
+
+# Serves cached `entry` (see entry2file); the ETag is based on the hash of the content
+def serve(entry, environ, start_response):
+  headers= [ ('Content-Type',entry['mime']), ('Content-Length',str(entry['size'])), ('ETag','"%s"' % entry['hash'][:32]) ]
+  if entry['modified']: headers.append( ('Last-Modified',entry['modified']) )
+  if headers[2][1] in environ.get('HTTP_IF_NONE_MATCH','') or (entry['modified'] is not None and entry['modified']==environ.get('HTTP_IF_MODIFIED_SINCE')):
+    start_response('304 Not Modified',headers[2:])
+    return []
+  file= entry2file(entry)
+  start_response('200 OK',headers)
+  if 'wsgi.file_wrapper' in environ: return environ['wsgi.file_wrapper'](file,ntlmpool.div_chunksize)
+  return file2chunks(file)
+
+
+# Splits the query string `arg` in the options (e.g. fit=1920x1026&fmt=webp&) and the url (which starts with http).
+# Returns a dict with the options (fit as a (width,height) tuple, fmt and q), or None when there are no options, and the url.
+def arg2options(arg):
+  options= {}
+  while arg.startswith(('fit=','fmt=','q=')) and '&' in arg:
+    option,arg= arg.split('&',1)
+    key,val= option.split('=',1)
+    options[key]= val
+  if not options: return None, arg
+  fit= options.get('fit','%dx%d' % (div_maxfit,div_maxfit)).split('x')
+  if len(fit)!=2 or not all(s.isdigit() and 0<int(s)<=div_maxfit for s in fit): raise Exception('fit must be <width>x<height>, up to %d' % div_maxfit)
+  fmt= options.get('fmt',div_format)
+  if fmt not in div_formats: raise Exception('fmt must be one of %s' % ', '.join(div_formats))
+  q= options.get('q',str(div_quality))
+  if not q.isdigit() or not 1<=int(q)<=100: raise Exception('q must be 1..100')
+  return { 'fit':(int(fit[0]),int(fit[1])), 'fmt':fmt, 'q':int(q) }, arg
+
+
+# Returns the content of the image in `file` (a path or an open file), scaled down (never up) to fit in `options['fit']`, in format `options['fmt']`
+def transcode(file, options):
+  with Image.open(file) as img:
+    img.draft('RGB',options['fit']) # jpeg only: decode at a reduced scale, much faster for photos
+    img= ImageOps.exif_transpose(img) # apply the camera orientation, the players ignore it
+    img.thumbnail(options['fit'],Image.LANCZOS)
+    if options['fmt']=='jpeg' and img.mode!='RGB': img= img.convert('RGB')
+    if options['fmt']=='webp' and img.mode not in ('RGB','RGBA'): img= img.convert('RGBA')
+    buffer= io.BytesIO()
+    img.save(buffer, format=options['fmt'], quality=options['q'], optimize=True)
+  return buffer.getvalue()
+
+
+# Returns the cache entry of the original image at `url`, loading it from sharepoint when it is not cached
+def original(url):
+  entry= cache.lookup(url)
+  if entry is not None:
+    if cache.stale(entry): cache.revalidate(url,reload)
+    return entry
+  response= ntlmpool.get(url,headers={'Accept-Encoding':'identity'})
+  if response.status_code!=200: raise Exception('Remote site failed with status %d' % response.status_code)
+  return store(url, response.content, response2meta(response))
+
+
+# Returns the cache entry of the variant of the image at `url` with `options`; the variant is made (once) from the cached original.
+# The variant records the hash of its original, so that it is made again when the original changed.
+# The quality is not part of the key of a png variant (png is lossless, it ignores q).
+def variant(url, options):
+  if cache is None: raise Exception('variants need the disk cache')
+  source= original(url)
+  key= '%s|fit=%dx%d&fmt=%s' % (url,options['fit'][0],options['fit'][1],options['fmt'])
+  if options['fmt']!='png': key+= '&q=%d' % options['q']
+  entry= cache.lookup(key)
+  if entry is not None and entry['source']==source['hash']: return entry
+  with entry2file(source) as file:
+    content= transcode(file, options)
+  return store(key, content, {'mime':div_formats[options['fmt']], 'etag':None, 'modified':source['modified'], 'source':source['hash']})
+
 
 def application(environ, start_response):
-  log= 'SYNTAX : sp?<url>\r\nexample: http://192.168.1.1/sp?http://sharepoint.company.com/pictures/banner.jpg\r\n\r\n'
+  log= 'SYNTAX : sp?[fit=<width>x<height>&][fmt=jpeg|webp|png&][q=<quality>&]<url>\r\nexample: http://192.168.1.1/sp?http://sharepoint.company.com/pictures/banner.jpg\r\nexample: http://192.168.1.1/sp?fit=1920x1026&fmt=webp&http://sharepoint.company.com/pictures/banner.jpg\r\n\r\n'
+  body= None
   try:
     arg= environ.get('QUERY_STRING')
     log+= 'arg    : "%s"\r\n' % arg
     if arg=='': raise Exception('&<url> argument missing')
+    options,arg= arg2options(arg)
     url= arg.replace(cfg.hostname,cfg.hostip) # Hack because DNS is not working
     log+= 'url    : "%s"\r\n' % url
-    session = requests.Session() 
-    response = session.get(url, auth=requests_ntlm.HttpNtlmAuth(cfg.username,cfg.password), headers={'Host':cfg.hostname} ) # Hack because DNS is not working
-    if response.status_code!=200: raise Exception('Remote site failed with status %d' % response.status_code)
+    # Serve a variant (scaled down and re-encoded for the display)
+    if options is not None:
+      log+= 'options: "%s"\r\n' % options
+      return serve(variant(url,options), environ, start_response)
+    # Serve from the cache (range requests go to sharepoint)
+    entry= cache.lookup(url) if cache is not None and 'HTTP_RANGE' not in environ else None
+    if entry is not None:
+      log+= 'cache  : "%s"%s\r\n' % (entry['hash'], ' (stale)' if cache.stale(entry) else '')
+      if cache.stale(entry): cache.revalidate(url,reload)
+      return serve(entry, environ, start_response)
+    # Not in cache, stream from sharepoint
+    headers= { name:environ[key] for key,name in request_headers if key in environ }
+    headers['Accept-Encoding']= 'identity' # so that the body we stream matches Content-Length
+    log+= 'headers: "%s"\r\n' % headers
+    response,body = ntlmpool.stream(url,headers=headers) # sends 'Host: cfg.hostname', hack because DNS is not working
+    if response.status_code not in (200,206,304): raise Exception('Remote site failed with status %d' % response.status_code)
     log+= 'status : "%d"\r\n' % response.status_code
-    mime= response.headers['Content-Type']
-    log+= 'mime   : "%s"\r\n' % mime
+    headers= [ (name,response.headers[name]) for name in response_headers if name in response.headers ]
+    log+= 'headers: "%s"\r\n' % headers
+    if cache is not None and response.status_code==200: body= cache.tee(url, response2meta(response), body) # also store it in the cache
     if False: raise Exception('Aborted for testing') # Change False to True for testing
-    start_response('200 OK',[('Content-type',mime)])
-    return [ response.content ]
+    start_response('%d %s' % (response.status_code,response.reason),headers)
+    return body # the webserver iterates over the chunks, and then closes body (returning the connection to the pool)
   except Exception as x:
+    if body is not None: body.close()
     log+='\r\nERROR  : %s\r\n' % str(x)
     start_response('404 ERROR',[('Content-type','text/plain')])
     return [ log.encode('utf-8') ]
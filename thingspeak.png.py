@@ -1,17 +1,118 @@
 # sudo pip install matplotlib
 # sudo apt-get install python-tk
 
-import matplotlib
-matplotlib.use('Agg')
-
-import matplotlib.pyplot as plt
+# The plot is drawn with the object-oriented matplotlib API (Figure and the Agg canvas), not with the global pyplot state,
+# so that requests can render in parallel (e.g. in a multi-threaded mod_wsgi daemon), each on its own figure.
+# With thingspeak.png?backend=pil the plot is drawn by pilchart.py (Pillow) instead; matplotlib is only imported when it is used.
 import json 
-import requests
 import os, sys, io
+import queue
+import threading
+import concurrent.futures
+import numpy as np
 from datetime import datetime,timedelta
 from dateutil import tz
 
-def application(environ, start_response):
+# Import fetch (pooled sessions), rendercache (shared output cache), scheduler (background refresh), singleflight (coalesced requests), pilchart (Pillow plots), encoder (WebP) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fetch, rendercache, scheduler, singleflight, pilchart, encoder, conditional
+import urllib.parse
+
+cache_ttl = 60 # seconds a plot is served from cache (and then again while refreshing)
+cache = rendercache.Cache(cache_ttl)
+
+webp_lossless = True # the WebP (for players that accept it) is lossless; a lossy one blurs the thin lines
+
+fetch_deadline = 20 # seconds to wait for the channels; a channel that is later (or fails) shows its previous data (or is left blank)
+workers = concurrent.futures.ThreadPoolExecutor(6) # the channels are fetched in parallel
+
+# The last `size` entries of one field of one ThingSpeak channel, kept in numpy arrays that are used as a ring buffer.
+# update() only fetches the entries newer than the last one seen, so a render costs the new points, not the whole window.
+class Series:
+    def __init__(self, channel, field, size):
+        self.channel = channel
+        self.field = field
+        self.size = size
+        self.times = np.zeros(size, dtype="datetime64[s]") # created_at (UTC)
+        self.values = np.zeros(size, dtype=np.float64)
+        self.count = 0 # number of entries in the buffer
+        self.next = 0 # index in the buffer for the next entry
+        self.last_id = 0 # entry_id of the newest entry
+        self.last_at = None # created_at of the newest entry
+        self.name = None # name of the channel
+        self.label = None # name of the field
+        self.lock = threading.Lock()
+
+    # Fetches the new entries from ThingSpeak and appends them
+    def update(self):
+        url = "https://thingspeak.com/channels/"+self.channel+"/field/"+self.field+".json?results="+str(self.size)
+        with self.lock:
+            # Entries from the newest one on (inclusive); entries already seen are skipped by their entry_id
+            if self.last_at is not None: url += "&start=" + self.last_at.replace("T","%20").rstrip("Z")
+        resp = fetch.load(url, timeout=fetch_deadline)
+        if resp.status_code!=200: raise Exception("Channel %s failed with status %d" % (self.channel,resp.status_code))
+        data = json.loads(resp.text)
+        key = "field%s" % self.field
+        with self.lock:
+            self.name = data["channel"]["name"]
+            self.label = data["channel"][key]
+            feeds = [feed for feed in data["feeds"] if feed["entry_id"]>self.last_id and feed[key] is not None]
+            if len(feeds)==0: return # a whole window of new entries (e.g. after a pause) overwrites all old ones in append()
+            # Convert in bulk: U19 cuts the trailing Z of '2019-02-27T08:00:56Z', numpy parses the rest as ISO 8601
+            times = np.array([feed['created_at'] for feed in feeds], dtype="U19").astype("datetime64[s]")
+            values = np.array([feed[key] for feed in feeds]).astype(np.float64)
+            self.append(times, values)
+            self.last_id = feeds[-1]["entry_id"]
+            self.last_at = feeds[-1]["created_at"]
+
+    # Appends the entries in arrays `times` and `values` to the ring buffer, dropping the oldest (lock must be held)
+    def append(self, times, values):
+        if len(values) > self.size:
+            times = times[-self.size:]
+            values = values[-self.size:]
+        index = (self.next + np.arange(len(values))) % self.size
+        self.times[index] = times
+        self.values[index] = values
+        self.next = (self.next + len(values)) % self.size
+        self.count = min(self.count + len(values), self.size)
+
+    # Returns (times,values,name,label) with copies of the entries (oldest first), or None when there are no entries yet
+    def snapshot(self):
+        with self.lock:
+            if self.count==0: return None
+            if self.count < self.size: return self.times[:self.count].copy(), self.values[:self.count].copy(), self.name, self.label
+            return np.roll(self.times,-self.next), np.roll(self.values,-self.next), self.name, self.label
+
+# The series, per (channel,field)
+store = {}
+store_lock = threading.Lock()
+
+# Returns the series for `field` of `channel` (created, with `size` entries, on first use)
+def series(channel, field, size):
+    with store_lock:
+        if (channel,field) not in store: store[(channel,field)] = Series(channel, field, size)
+        return store[(channel,field)]
+
+# Figures are built once (2x3 axes, each with an empty line) and reused; a render only swaps the line data and the labels.
+# A render takes a figure from the pool (or builds one when all are in use) and returns it afterwards.
+figures = queue.LifoQueue()
+
+# Builds a figure with 2x3 axes, each with one (empty) line, returns (figure,axes,lines)
+def build():
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=[19.2*0.8,10*0.8])
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(2,3).flatten()
+    lines = []
+    for ax in axes:
+        ax.xaxis_date(tz.tzutc()) # the times are shifted to the local zone before plotting (see plot)
+        lines.append(ax.plot([], [], '.-')[0])
+        ax.set_xlabel('Date')
+        ax.get_yaxis().get_major_formatter().set_useOffset(False)
+    return fig, axes, lines
+
+# Loads the channels from ThingSpeak and plots them with `backend` ("matplotlib" or "pil"), returns png bytes
+def render(backend="matplotlib"):
     info_plot = [["249563","2","#ffd43b","600"], #ENS210.H [may be changed]                 
                  ["616372","2","#e74c3c", "300"], #CCS811.eTVOC [may be changed]  
                  ["381884","1","#34495e", "300"], #iAQcore.CO2 [may be changed]
@@ -20,51 +121,106 @@ def application(environ, start_response):
                  ["320672","1","#2ecc71","600"]] #ENS220.P [may be changed]
                  
     
-    data = []
-    from_zone = tz.tzutc()
-    to_zone = tz.tzlocal()
-    for idata in range(len(info_plot)):          
-        url= "https://thingspeak.com/channels/"+info_plot[idata][0]+"/field/"+info_plot[idata][1]+".json?results="+info_plot[idata][3]
-        resp= requests.get(url)
-        text= resp.text
-        data.append(json.loads(text))
-
-    plt.ioff()
-    fig = plt.figure(figsize=[19.2*0.8,10*0.8])
-   
+    # Update all channels in parallel; a channel that failed or missed the deadline keeps its previous entries
+    stores = [series(info[0], info[1], int(info[3])) for info in info_plot]
+    futures = [workers.submit(s.update) for s in stores]
+    concurrent.futures.wait(futures, timeout=fetch_deadline)
+    data = [s.snapshot() for s in stores] # None for a channel that never loaded
+    if all(d is None for d in data): raise Exception("No channel could be loaded from ThingSpeak")
+    if backend=="pil": return render_pil(info_plot, data)
+
+    try:
+        fig, axes, lines = figures.get_nowait()
+    except queue.Empty:
+        fig, axes, lines = build()
+    try:
+        plot(fig, axes, lines, info_plot, data)
+        with io.BytesIO() as memfile:
+            fig.savefig(memfile, format="png")
+            bytes = memfile.getvalue()
+    finally:
+        figures.put((fig, axes, lines))
+    return bytes
+
+# Plots the channel `data` with pilchart, returns png bytes
+def render_pil(info_plot, data):
+    offset = localoffset()
+    panels = []
     for idata in range(len(info_plot)):
-        data_feeds = data[idata]["feeds"]
-        dtime = []
-        plotdata = []
-        plotname = data[idata]["channel"]["field%s" %info_plot[idata][1]]
-        for idx in range(len(data_feeds)):
-            utc = datetime.strptime(data_feeds[idx]['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-            utc = utc.replace(tzinfo = from_zone)
-            central = utc.astimezone(to_zone)
-            dtime.append(central)
-            plotdata.append(float(data_feeds[idx]["field%s" %info_plot[idata][1]])) 
-            
-        plt.subplot(int("23"+str(idata+1)))
-        plt.plot(dtime, plotdata,'.-', color = info_plot[idata][2])
-        plt.xlabel('Date')
-        plt.ylabel(plotname)
-        plt.title(data[idata]["channel"]["name"]) 
-        
-        ax = plt.gca()
-        ax.get_yaxis().get_major_formatter().set_useOffset(False)
+        if data[idata] is None:
+            panels.append({"title":"Channel %s (no data)" % info_plot[idata][0]})
+            continue
+        dtime, plotdata, channelname, plotname = data[idata]
+        keep = lttb(dtime.astype(np.float64), plotdata, pilchart.div_width//3)
+        panels.append({"title":channelname, "xlabel":"Date", "ylabel":plotname, "x":dtime[keep]+offset, "y":plotdata[keep], "color":info_plot[idata][2]})
+    image = pilchart.grid(panels, 2, 3)
+    with io.BytesIO() as memfile:
+        image.save(memfile, format="png")
+        return memfile.getvalue()
+
+# Returns the offset of the local zone to UTC as numpy timedelta (the current one, so a DST switch in the window is not followed)
+def localoffset():
+    return np.timedelta64(int(datetime.now(tz.tzlocal()).utcoffset().total_seconds()), 's')
+
+# Returns the indices of at most `n` points of (`x`,`y`) that keep the shape of the curve: Largest-Triangle-Three-Buckets.
+# The first and last point are kept; the points in between are split in n-2 buckets, and from each bucket the point is kept
+# that makes the largest triangle with the point kept from the previous bucket and the average of the next bucket.
+def lttb(x, y, n):
+    if n < 3 or len(x) <= n: return np.arange(len(x))
+    edges = np.linspace(1, len(x)-1, n-1).astype(int) # bucket i is edges[i]..edges[i+1]
+    keep = np.zeros(n, dtype=int)
+    keep[-1] = len(x)-1
+    a = 0
+    for i in range(n-2):
+        lo, hi = edges[i], edges[i+1]
+        nhi = edges[i+2] if i+2 < n-1 else len(x)
+        cx, cy = x[hi:nhi].mean(), y[hi:nhi].mean()
+        areas = np.abs( (x[a]-cx)*(y[lo:hi]-y[a]) - (x[a]-x[lo:hi])*(cy-y[a]) )
+        a = lo + int(areas.argmax())
+        keep[i+1] = a
+    return keep
+
+# Puts the channel `data` in the `lines` of the `axes` of figure `fig`
+def plot(fig, axes, lines, info_plot, data):
+    # The times are in UTC; shift them to the local zone with one offset
+    offset = localoffset()
+    for idata in range(len(info_plot)):
+        ax = axes[idata]
+        line = lines[idata]
+        if data[idata] is None:
+            line.set_data([], [])
+            ax.set_title("Channel %s (no data)" % info_plot[idata][0])
+            ax.set_axis_off()
+            continue
+        dtime, plotdata, channelname, plotname = data[idata]
+        # More points than pixels do not add detail, only render time: keep about one point per pixel column
+        keep = lttb(dtime.astype(np.float64), plotdata, int(ax.bbox.width))
+        line.set_data(dtime[keep] + offset, plotdata[keep])
+        line.set_color(info_plot[idata][2])
+        ax.set_axis_on()
+        ax.set_ylabel(plotname)
+        ax.set_title(channelname) 
+        ax.relim()
+        ax.autoscale_view()
         
-    plt.tight_layout()
+    fig.tight_layout()
 
-    with io.BytesIO() as memfile:
-        plt.savefig(memfile, format="png")
-        bytes = memfile.getvalue()
-    plt.close(fig)
-    
+def application(environ, start_response):
+    params = urllib.parse.parse_qs(environ.get('QUERY_STRING',''))
+    backend = "pil" if params.get('backend',[''])[0]=="pil" else "matplotlib" # default: matplotlib
+    bytes = cache.get(rendercache.normalize({"backend":backend}), lambda: render(backend))
     status = '200 OK'
     response_header = [('Content-type','image/png')]
     start_response(status,response_header)
     return [bytes]
 
+# Keep the plot warm in the background
+application = scheduler.register(singleflight.wrap(application), minimum=60, maximum=600)
+# Serve the image as WebP to players that accept that (made once per image)
+application = encoder.negotiate(application, lossless=webp_lossless)
+# Answer players that have the image already (ETag or time) with 304 Not Modified
+application = conditional.wrap(application)
+
 if __name__ == "__main__":
      application({},{})
 
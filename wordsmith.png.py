@@ -28,14 +28,16 @@ version = "v1"
 # sudo python3 -m pip install xmltodict
 
 import os
-import io
-import requests
+import sys
 import xmltodict
 import json
+import threading
 from PIL import Image
-from PIL import ImageFont
 from PIL import ImageDraw
 
+# Import fetch (shared upstream cache), rendercache (shared output cache), scheduler (background refresh), singleflight (coalesced requests), fontcache (loaded fonts), encoder (palette png, WebP) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fetch, rendercache, scheduler, singleflight, fontcache, encoder, conditional
+
 # Drawing settings
 div_color_amsgrey1=( 70, 85, 95)      # color code for ams dark grey
 div_color_amsgrey2=(125,136,143)      # color code for ams medium grey
@@ -56,28 +58,37 @@ div_sY= 0                             # line1/line2 extra spacing
 
 div_url="https://wordsmith.org/awad/rss1.xml"
 
+div_cache_ttl=3600                    # seconds a generated image is served from cache (and then again while refreshing)
+div_png_palette=True                  # encode the image with a palette (one byte per pixel) when its colors allow it
+div_png_level=9                       # zlib compression level of the png (1 is fastest, 9 is smallest); rendered once an hour
+div_png_optimize=True                 # extra (slow) effort to find the smallest png
+div_webp_lossless=True                # WebP (for players that accept it) is lossless, or lossy at div_webp_quality
+div_webp_quality=80                   # WebP quality (lossy) or effort (lossless), 0-100
+
+# Generated image (there are no parameters, so there is only one key)
+cache = rendercache.Cache(div_cache_ttl)
+
+# The log of the request or render in progress, one per thread: renders also run in the background threads of rendercache and scheduler
+local = threading.local()
+
 
 # Adds the path of this script to fonts\`filename` to make it an absolute path
 def getFontPath(filename):
-  global log
   folder = os.path.dirname(os.path.realpath(__file__))
   path = os.path.join(folder, os.path.join("fonts",filename))
-  log+= f"font   : {path}\r\n"
+  local.log+= f"font   : {path}\r\n"
   return path
 
 
 # Converts
 def generateimg(text1,text2) :
-  global log
-  # Render temp image to determine size
-  img = Image.new("RGBA", (10,10), div_bgcol )
-  draw = ImageDraw.Draw(img)
-  font_text1 = ImageFont.truetype(getFontPath(div_txt_fontname), div_txt_fontsize)
-  size1x,size1y= draw.textsize( text1, font=font_text1)
-  size2x,size2y= draw.textsize( text2, font=font_text1)
-  log+= f"size   : {size1x}x{size1y} and {size2x}x{size2y}\r\n"
+  # Determine size (measured, no temp image needed)
+  font_text1 = fontcache.truetype(getFontPath(div_txt_fontname), div_txt_fontsize)
+  size1x,size1y= fontcache.textsize( text1, font_text1)
+  size2x,size2y= fontcache.textsize( text2, font_text1)
+  local.log+= f"size   : {size1x}x{size1y} and {size2x}x{size2y}\r\n"
   # String text2 is set in same font as text1, now scale to make same width as text1
-  font_text2 = ImageFont.truetype(getFontPath(div_txt_fontname), int(div_txt_fontsize*size1x/size2x))
+  font_text2 = fontcache.truetype(getFontPath(div_txt_fontname), int(div_txt_fontsize*size1x/size2x))
   size2y = int( size2y * size1x/size2x )
   size2x = int( size2x * size1x/size2x )
   # Determine image size
@@ -98,63 +109,71 @@ def indent(s) :
   return s.replace("\n","\n         ")
 
 
+# Converts the rss feed in response `resp` to a dict
+def parseresp(resp) :
+  return xmltodict.parse(resp.text)
+
+
 # Fixed URL to tuple of image and image bytes
 def url2img(url) :
-  global log
-  log= "SYNTAX : wordsmith.png\r\n\r\n"
+  local.log= "SYNTAX : wordsmith.png\r\n\r\n"
   # Load remote rss feed
-  log+= f"request: {url}\r\n"
-  resp= requests.get(url)
+  local.log+= f"request: {url}\r\n"
+  resp= fetch.get(url, ttl=3600) # word of the day
   data= resp.text
-  log+= f"data   : {indent(data)}\r\n"
-  # Convert rss string to dict and extract item
-  dict = xmltodict.parse(data)
-  log+= f"parsed : dict ok\r\n"
+  local.log+= f"data   : {indent(data)}\r\n"
+  # Convert rss string to dict (only when the feed changed) and extract item
+  dict = fetch.memo(resp, parseresp)
+  local.log+= f"parsed : dict ok\r\n"
   item = dict["rss"]["channel"]["item"]
-  log+= f"item   : {item}\r\n"
+  local.log+= f"item   : {item}\r\n"
   title = item["title"]
-  log+= f"  title: {title}\r\n"
+  local.log+= f"  title: {title}\r\n"
   description = item["description"]
-  log+= f"  desc : {description}\r\n\r\n"
+  local.log+= f"  desc : {description}\r\n\r\n"
   # Convert to image
   image = generateimg(title,description)
-  log+= f"image  : created {image.width}x{image.height}\r\n"
+  local.log+= f"image  : created {image.width}x{image.height}\r\n"
   # Send image to web client
-  with io.BytesIO() as memfile:
-    image.save(memfile, format="png")
-    bytes= memfile.getvalue()
-  log+= f"bytes  : created {len(bytes)}\r\n"
+  bytes= encoder.png(image, palette=div_png_palette, compress_level=div_png_level, optimize=div_png_optimize)
+  local.log+= f"bytes  : created {len(bytes)}\r\n"
   return image,bytes
 
 
 # The entry point of the webserver
 def application(environ, start_response):
-  global log
-  log = ""
+  local.log = ""
   try:
-    image,bytes = url2img(div_url)
+    bytes = cache.get( "", lambda: url2img(div_url)[1] )
     # raise Exception("Aborted for testing") # Uncomment for testing
     start_response("200 OK",[("Content-type","image/png")])
     return [bytes]
   except Exception as x:
-    log+= f"\r\nERROR  : {x}\r\n"
+    local.log+= f"\r\nERROR  : {x}\r\n"
     start_response("404 ERROR",[("Content-type","text/plain")])
-    return [ log.encode("utf-8") ]
+    return [ local.log.encode("utf-8") ]
+
+
+# Keep the image warm in the background (the word changes once a day)
+application = scheduler.register(singleflight.wrap(application), minimum=600, maximum=6*3600)
+# Serve the image as WebP to players that accept that (made once per image)
+application = encoder.negotiate(application, lossless=div_webp_lossless, quality=div_webp_quality)
+# Answer players that have the image already (ETag or time) with 304 Not Modified
+application = conditional.wrap(application)
 
 
 # The entry point for commandline test
 if __name__ == "__main__":
-  global log
-  log = ""
+  local.log = ""
   try:
     image,bytes = url2img(div_url)
     name = "trial.png"
     image.save(name)
-    log+= f"png    : saved {name}\r\n"
-    print(log)
+    local.log+= f"png    : saved {name}\r\n"
+    print(local.log)
   except Exception as x:
-    log+= f"\r\nERROR  : {x}\r\n"
-    print(log)
+    local.log+= f"\r\nERROR  : {x}\r\n"
+    print(local.log)
 
 
 
@@ -29,10 +29,13 @@ version = "v3"
 
 
 import sys
+import os
 import ntpath
-import requests
 from xml.dom import minidom
 
+# Import fetch (shared upstream cache), scheduler (background refresh), singleflight (coalesced requests) and conditional (ETag, 304), they live next to this script
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) ); import fetch, scheduler, singleflight, conditional
+
 
 # Get the text string from an element
 def text(elm):
@@ -68,17 +71,21 @@ def parse(page):
     desc= imgs[0].getAttribute("title")
     return (title, desc, imgurl)
 
-# Loads the XKCD rss feed, parses it and returns a triple (title, desc, imgurl).
+# Parses the XKCD rss feed in response `resp` (memoized via fetch.memo, so only redone when the feed changed)
+def parseresp(resp):
+    return parse(resp.text)
+
+# Loads the XKCD rss feed, parses it and returns a triple (title, desc, imgurl) and whether that failed.
 # In case of errors, an "error triple" is returned.
 def loadtriple():
     try:
         url= 'https://xkcd.com/rss.xml'
-        resp= requests.get(url)
-        triple= parse(resp.text)
-        if triple==None: triple=('Parse error',url, 'https://imgs.xkcd.com/comics/not_available.png')
+        resp= fetch.get(url, ttl=600)
+        triple= fetch.memo(resp, parseresp)
+        if triple==None: return ('Parse error',url, 'https://imgs.xkcd.com/comics/not_available.png'), True
     except:
-        triple=('Load error',url, 'https://imgs.xkcd.com/comics/not_available.png')
-    return triple
+        return ('Load error',url, 'https://imgs.xkcd.com/comics/not_available.png'), True
+    return triple, False
 
 # Converts a triple (title, desc, imgurl) to an rss (xml) string
 def rss(triple):
@@ -97,12 +104,19 @@ def rss(triple):
     
 # The entry point of the webserver
 def application(environ, start_response):
-    xml= rss(loadtriple())
-    start_response( '200 OK' , [('Content-type','text/xml')] )
+    triple,failed= loadtriple()
+    xml= rss(triple)
+    # An error triple is served, but marked so that the scheduler keeps the previous good channel
+    start_response( '200 OK' , [('Content-type','text/xml')] + ([scheduler.fallback] if failed else []) )
     return [xml.encode()]
 
+# Keep the channel warm in the background (xkcd changes a few times a week)
+application= scheduler.register(singleflight.wrap(application), minimum=600, maximum=6*3600)
+# Answer players that have the channel already (ETag or time) with 304 Not Modified
+application= conditional.wrap(application)
+
 # The entry point for commandline test
 if __name__ == "__main__":
-    xml= rss(loadtriple())
+    xml= rss(loadtriple()[0])
     print( xml )
  